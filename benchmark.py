@@ -0,0 +1,414 @@
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+from bs4 import BeautifulSoup
+from extract import ExtractionPlan
+import domains
+
+ROOT = path.dirname(path.abspath(__file__))
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore '
+         'magna aliqua ut enim ad minim veniam quis nostrud exercitation ullamco laboris nisi').split()
+
+
+class SyntheticSite:
+    '''
+    Generated site graph. Page i always links to page i + 1 so that every page can be reached, plus fanout random
+    pages. A fraction of the links are root relative. Every page also links to non html assets, and a few pages are
+    slow or never answer. The same seed always generates the same site
+    '''
+
+    def __init__(self, pages=1000, fanout=10, page_size=20000, assets=2, slow=0, slow_delay=1.0, hung=0,
+                 hang_seconds=600.0, seed=1):
+        '''
+        :param pages: Number of html pages
+        :param fanout: Number of random links per page
+        :param page_size: Approximate size of a page in bytes
+        :param assets: Number of non html assets linked from every page
+        :param slow: Number of pages that take slow_delay seconds to answer
+        :param slow_delay: Seconds a slow page takes
+        :param hung: Number of pages that never answer
+        :param hang_seconds: Seconds a hung page holds the connection before giving up
+        :param seed: Random seed
+        '''
+        self.pages = pages
+        self.slow_delay = slow_delay
+        self.hang_seconds = hang_seconds
+        rand = random.Random(seed)
+        special = rand.sample(range(1, pages), min(pages - 1, slow + hung))
+        self.slow = set(special[:slow])
+        self.hung = set(special[slow:])
+        self.bodies = {}
+        for i in range(pages):
+            links = [i + 1] if i + 1 < pages else []
+            links.extend(rand.randrange(pages) for _ in range(fanout))
+            parts = ['<html><head><title>Page {0}</title><script src="/static/s{0}.js"></script></head>'
+                     '<body><h1>Page {0}</h1><ul>'.format(i)]
+            for link in links:
+                if rand.random() < 0.3:
+                    parts.append('<li><a href="/p{0}.html">page {0}</a></li>'.format(link))
+                else:
+                    parts.append('<li><a href="{{base}}p{0}.html">page {0}</a></li>'.format(link))
+            for j in range(assets):
+                parts.append('<li><a href="{{base}}assets/a{0}-{1}.png">asset</a></li>'.format(i, j))
+            parts.append('</ul>')
+            size = sum(len(part) for part in parts)
+            paragraph = 0
+            while size < page_size:
+                text = ' '.join(rand.choice(WORDS) for _ in range(60))
+                part = '<div class="c{0}"><p>{1}</p><span>{2}</span></div>\n'.format(paragraph % 7, text, paragraph)
+                parts.append(part)
+                size += len(part)
+                paragraph += 1
+            parts.append('</body></html>')
+            self.bodies['/p{}.html'.format(i)] = ''.join(parts)
+        self.asset = bytes(rand.randrange(256) for _ in range(2048))
+
+    def url(self, base, page):
+        return '{0}p{1}.html'.format(base, page)
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The crawler drops keep-alive connections when it exits or gives up on a page
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class SiteServer:
+    '''
+    Serves a SyntheticSite on a local port from a background thread and records the time every request took
+    '''
+
+    def __init__(self, site, host='127.0.0.1', port=0):
+        self.site = site
+        self.latencies = []
+        self.counts = {'html': 0, 'asset': 0, 'slow': 0, 'hung': 0, 'missing': 0}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                start = time.perf_counter()
+                kind = server.respond(self)
+                if kind == 'hung':
+                    return
+                with server._lock:
+                    server.counts[kind] += 1
+                    server.latencies.append(time.perf_counter() - start)
+
+        self.httpd = QuietHTTPServer((host, port), Handler)
+        self.base = 'http://{0}:{1}/'.format(host, self.httpd.server_address[1])
+        self.bodies = {urlpath: body.replace('{base}', self.base).encode('utf-8')
+                       for urlpath, body in site.bodies.items()}
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def respond(self, handler):
+        '''
+        Answers a request
+        :param handler: The request handler
+        :return: Kind of the request, a key of counts
+        '''
+        urlpath = handler.path.split('?')[0]
+        if urlpath.startswith('/assets/') or urlpath.startswith('/static/'):
+            self._send(handler, 200, 'image/png', self.site.asset)
+            return 'asset'
+        body = self.bodies.get(urlpath, None)
+        if body is None:
+            self._send(handler, 404, 'text/html', b'<html><body>Not found</body></html>')
+            return 'missing'
+        page = int(urlpath[2:-5])
+        kind = 'html'
+        if page in self.site.hung:
+            # Holds the connection without answering. The crawler has to give up on its own
+            with self._lock:
+                self.counts['hung'] += 1
+            time.sleep(self.site.hang_seconds)
+            handler.close_connection = True
+            return 'hung'
+        if page in self.site.slow:
+            time.sleep(self.site.slow_delay)
+            kind = 'slow'
+        self._send(handler, 200, 'text/html; charset=utf-8', body)
+        return kind
+
+    def _send(self, handler, status, content_type, body):
+        try:
+            handler.send_response(status)
+            handler.send_header('Content-Type', content_type)
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            handler.close_connection = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def percentile(values, pct):
+    '''
+    :param values: List of numbers
+    :param pct: Percentile between 0 and 100
+    :return: Nearest rank percentile, or None if values is empty
+    '''
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round((len(values) - 1) * pct / 100.0)))]
+
+
+def dir_size(dirname):
+    total = 0
+    for dirpath, _, filenames in os.walk(dirname):
+        for filename in filenames:
+            total += path.getsize(path.join(dirpath, filename))
+    return total
+
+
+def time_extraction(site, data, base, sample=200):
+    '''
+    Times parsing and extraction of site pages outside of the crawler, with the parser settings of data
+    :param site: SyntheticSite
+    :param data: Crawler input json
+    :param base: Base url the pages are served under
+    :param sample: Number of pages to time
+    :return: Dictionary of mean milliseconds per page
+    '''
+    plan = ExtractionPlan(data['HTMLElementList'])
+    strainer = plan.strainer() if data.get('soupStrainer', False) else None
+    features = data.get('parser', 'html.parser')
+    bodies = [body.replace('{base}', base) for body in list(site.bodies.values())[:sample]]
+    parse = 0.0
+    extract = 0.0
+    for urlid, body in enumerate(bodies):
+        start = time.perf_counter()
+        soup = BeautifulSoup(body, features, parse_only=strainer)
+        parse += time.perf_counter() - start
+        start = time.perf_counter()
+        anchors, element_data = plan.extract(urlid, soup)
+        for ele in anchors:
+            plan.link_data(urlid, ele)
+        extract += time.perf_counter() - start
+    return {'parseMs': parse / max(len(bodies), 1) * 1000, 'extractMs': extract / max(len(bodies), 1) * 1000}
+
+
+def run_crawler(data, workdir, timeout=None):
+    '''
+    Runs pageminer.py end to end on data in workdir
+    :return: Tuple of (exit code, seconds, peak rss in MB of the crawler and its worker processes)
+    '''
+    with open(path.join(workdir, 'input.json'), 'w') as f:
+        json.dump(data, f)
+    start = time.perf_counter()
+    with open(path.join(workdir, 'stdout.txt'), 'w') as out:
+        process = subprocess.Popen([sys.executable, path.join(ROOT, 'pageminer.py'), 'input.json'], cwd=workdir,
+                                   stdout=out, stderr=subprocess.STDOUT)
+        try:
+            code = process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            code = process.wait()
+    seconds = time.perf_counter() - start
+    # ru_maxrss is the largest of the waited for children, in KB on linux and bytes on mac. It can include the memory of
+    # this process, which the child was forked from, so the peak the crawler reports in its metrics is preferred
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    peak = maxrss / (1024 * 1024) if sys.platform == 'darwin' else maxrss / 1024
+    return code, seconds, peak
+
+
+def read_metrics(filename):
+    '''
+    Combines the last metrics line of every crawler process
+    :param filename: Metrics file written by the crawler
+    :return: Dictionary with the fetch latency percentiles, peak rss of the largest process and the sum over all
+    processes and the mean milliseconds per page of every stage, or None if there is no metrics file
+    '''
+    if not path.exists(filename):
+        return None
+    last = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            snapshot = json.loads(line)
+            last[snapshot['pid']] = snapshot
+    snapshots = [snapshot for snapshot in last.values() if snapshot['pages'] > 0]
+    if len(snapshots) == 0:
+        return None
+    pages = sum(snapshot['pages'] for snapshot in snapshots)
+    stages = {}
+    for snapshot in snapshots:
+        for stage, values in snapshot['stages'].items():
+            stages[stage] = stages.get(stage, 0.0) + values['seconds']
+    # Percentiles of separate processes can't be merged exactly. The median is weighted by pages, p99 is the worst
+    return {
+        'latencyP50Ms': sum((snapshot['latencyP50Ms'] or 0) * snapshot['pages'] for snapshot in snapshots) / pages,
+        'latencyP99Ms': max(snapshot['latencyP99Ms'] or 0 for snapshot in snapshots),
+        'peakRssMB': max(snapshot.get('peakRssMB', 0) for snapshot in snapshots),
+        'totalPeakRssMB': sum(snapshot.get('peakRssMB', 0) for snapshot in snapshots),
+        'stagesMsPerPage': {stage: seconds / pages * 1000 for stage, seconds in stages.items()}
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    '''
+    Generates the site, serves it and crawls it
+    :param args: Parsed command line arguments
+    :return: Dictionary of results
+    '''
+    site = SyntheticSite(args.pages, args.fanout, args.page_size, args.assets, args.slow, args.slow_delay, args.hung,
+                         args.hang_seconds, args.seed)
+    server = SiteServer(site)
+    server.start()
+    step = max(1, args.pages // args.sites)
+    data = {
+        'depth': args.depth,
+        'scrapeSameDomain': True,
+        'saveFileDir': 'out',
+        'HTMLElementList': ['title', 'script:src', 'h1', 'p', 'span', 'a:href'],
+        'runURL': [{'ID': str(i + 1), 'URL': site.url(server.base, i * step)} for i in range(args.sites)],
+        'pstrings': '',
+        'totalTimeout': args.timeout,
+        'retries': 0,
+        'metricsFile': 'metrics.jsonl',
+        'statsInterval': 3600
+    }
+    if args.config is not None:
+        if path.exists(args.config):
+            with open(args.config, 'r') as f:
+                data.update(json.load(f))
+        else:
+            data.update(json.loads(args.config))
+    workdir = tempfile.mkdtemp(prefix='pageminer-bench-')
+    try:
+        try:
+            code, seconds, peak = run_crawler(data, workdir, args.max_seconds)
+        finally:
+            server.stop()
+        pages = server.counts['html'] + server.counts['slow']
+        results = {
+            'exitCode': code,
+            'seconds': seconds,
+            'pages': pages,
+            'requests': dict(server.counts),
+            'pagesPerSec': pages / seconds,
+            'serverP50Ms': (percentile(server.latencies, 50) or 0) * 1000,
+            'serverP99Ms': (percentile(server.latencies, 99) or 0) * 1000,
+            'bytesWritten': dir_size(path.join(workdir, 'out')),
+            'journalBytes': dir_size(path.join(workdir, 'status')),
+            'peakRssMB': peak
+        }
+        crawler = read_metrics(path.join(workdir, data['metricsFile']))
+        if crawler is not None:
+            results['fetchP50Ms'] = crawler['latencyP50Ms']
+            results['fetchP99Ms'] = crawler['latencyP99Ms']
+            results['stagesMsPerPage'] = crawler['stagesMsPerPage']
+            results['peakRssMB'] = crawler['peakRssMB']
+            results['totalPeakRssMB'] = crawler['totalPeakRssMB']
+        results.update(time_extraction(site, data, server.base, args.parse_sample))
+        results['domains'] = domains.benchmark([site.url(server.base, i) for i in range(args.pages)] +
+                                               ['https://www.site{0}.co.uk/p{1}.html'.format(i % 100, i)
+                                                for i in range(10000)])
+    finally:
+        if args.keep:
+            print('Crawler output kept in {}'.format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'site': {'pages': args.pages, 'fanout': args.fanout, 'pageSize': args.page_size, 'assets': args.assets,
+                 'slow': args.slow, 'slowDelay': args.slow_delay, 'hung': args.hung, 'seed': args.seed},
+        'input': {key: value for key, value in data.items() if key != 'runURL'},
+        'results': results
+    }
+
+
+def compare(result, baseline):
+    '''
+    Prints the change of the main metrics between a baseline result and a new one
+    '''
+    keys = ['pagesPerSec', 'fetchP50Ms', 'fetchP99Ms', 'serverP50Ms', 'serverP99Ms', 'parseMs', 'extractMs',
+            'bytesWritten', 'peakRssMB']
+    stages = sorted(set(baseline['results'].get('stagesMsPerPage', {})) &
+                    set(result['results'].get('stagesMsPerPage', {})))
+    for key in keys + stages:
+        if key in stages:
+            old = baseline['results']['stagesMsPerPage'][key]
+            new = result['results']['stagesMsPerPage'][key]
+        else:
+            old = baseline['results'].get(key, None)
+            new = result['results'].get(key, None)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old != 0 else 0.0
+        print('{0:>14}: {1:>12.2f} -> {2:>12.2f} ({3:+.1f}%)'.format(key, old, new, change))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Crawls a generated local site and reports crawl performance')
+    parser.add_argument('--pages', type=int, default=500, help='Number of html pages')
+    parser.add_argument('--fanout', type=int, default=8, help='Random links per page')
+    parser.add_argument('--page-size', type=int, default=20000, help='Approximate page size in bytes')
+    parser.add_argument('--assets', type=int, default=2, help='Non html assets linked per page')
+    parser.add_argument('--slow', type=int, default=5, help='Number of slow pages')
+    parser.add_argument('--slow-delay', type=float, default=0.5, help='Seconds a slow page takes')
+    parser.add_argument('--hung', type=int, default=2, help='Number of pages that never answer')
+    parser.add_argument('--hang-seconds', type=float, default=600, help='Seconds a hung page holds the connection')
+    parser.add_argument('--timeout', type=float, default=3, help='totalTimeout of the crawler')
+    parser.add_argument('--sites', type=int, default=1, help='Number of runURL entries')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--config', type=str, default=None,
+                        help='Json file or string merged into the crawler input, e.g. \'{"concurrency": 8}\'')
+    parser.add_argument('--parse-sample', type=int, default=200, help='Number of pages parse time is measured on')
+    parser.add_argument('--max-seconds', type=float, default=None, help='Kill the crawler after this many seconds')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Result file. Defaults to benchmarks/<commit>-<time>.json')
+    parser.add_argument('--compare', type=str, default=None, help='Earlier result file to compare with')
+    parser.add_argument('--keep', action='store_true', help='Keep the crawler output directory')
+    args = parser.parse_args()
+    result = run_benchmark(args)
+    print(json.dumps(result['results'], indent=2))
+    output = args.output
+    if output is None:
+        output = path.join('benchmarks', '{0}-{1}.json'.format(result['commit'] or 'nogit',
+                                                              datetime.now().strftime('%y%m%d-%H%M%S')))
+    if path.dirname(output) != '' and not path.exists(path.dirname(output)):
+        os.makedirs(path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('Results saved to {}'.format(output))
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(result, json.load(f))
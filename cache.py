@@ -0,0 +1,107 @@
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from os import path
+from sinks import check_create_dir
+from frontier import normalize_url
+
+
+class CacheMiss(Exception):
+    '''
+    Raised in replay mode for pages that are not in the cache
+    '''
+
+
+class ResponseCache:
+    '''
+    On-disk cache of fetched pages, keyed by normalized url and stored in a sqlite database in dirname.
+    Bodies are zlib compressed and saved with their ETag and Last-Modified headers so that later runs can send
+    conditional requests and reuse the cached body when the server answers 304.
+    Entries of the least recently used pages are evicted once the compressed bodies exceed max_bytes.
+    The size is tracked per process, so with the parallel runner the cache can briefly grow past max_bytes
+    '''
+
+    def __init__(self, dirname, max_bytes=1024 * 1024 * 1024):
+        '''
+        :param dirname: Directory to keep the cache database in
+        :param max_bytes: Maximum total size of the compressed bodies
+        '''
+        check_create_dir(dirname)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path.join(dirname, 'cache.db'), timeout=60, check_same_thread=False)
+        # The cache can always be refetched, so commits don't need to wait for the disk
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, content_type TEXT, etag TEXT, '
+                         'last_modified TEXT, body BLOB, size INTEGER, accessed REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self._db.commit()
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        '''
+        :param url: The url to look up
+        :return: Dictionary with content_type, etag, last_modified and text (None for non html pages),
+        or None if the url is not cached
+        '''
+        key = normalize_url(url)
+        with self._lock:
+            row = self._db.execute('SELECT content_type, etag, last_modified, body FROM entries WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+            self._db.commit()
+        text = zlib.decompress(row[3]).decode('utf-8') if row[3] is not None else None
+        return {'content_type': row[0], 'etag': row[1], 'last_modified': row[2], 'text': text}
+
+    def conditional_headers(self, entry):
+        '''
+        :param entry: Cache entry from get
+        :return: Dictionary of headers that make a request conditional on the cached version
+        '''
+        headers = {}
+        if entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, url, response, text):
+        '''
+        Saves a fetched page
+        :param url: The url that was fetched
+        :param response: The response of the fetch
+        :param text: Page text, or None for pages that are not html
+        '''
+        logger = logging.getLogger(__name__ + '.put')
+        key = normalize_url(url)
+        body = zlib.compress(text.encode('utf-8')) if text is not None else None
+        size = len(body) if body is not None else 0
+        with self._lock:
+            row = self._db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._size -= row[0]
+            self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (key, response.headers.get('content-type', None), response.headers.get('etag', None),
+                              response.headers.get('last-modified', None), body, size, time.time()))
+            self._size += size
+            while self._size > self.max_bytes:
+                oldest = self._db.execute('SELECT key, size FROM entries ORDER BY accessed LIMIT 1').fetchone()
+                if oldest is None or oldest[0] == key:
+                    break
+                logger.debug('Evicting %s', oldest[0])
+                self._db.execute('DELETE FROM entries WHERE key = ?', (oldest[0],))
+                self._size -= oldest[1]
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,193 @@
+import json
+import logging
+import os
+from os import path
+from sinks import check_create_dir
+
+
+class CheckpointJournal:
+    '''
+    Append-only journal of a site's scrape progress, saved as status/journal-[ID].jsonl.
+    Every discovered link and every completed page is a single json line, so a checkpoint costs the same no matter
+    how large the frontier is, and a resumed scrape continues from the exact page it stopped at.
+    Records are buffered until commit(). When the journal has grown to compact_ratio times its size after the last
+    compaction it is rewritten with one line per link.
+    Only the urlids of scraped pages are kept in memory. Links are streamed from the journal file when it is compacted
+    or resumed, so memory doesn't grow with the number of discovered links
+    '''
+
+    def __init__(self, dirname, id, compact_ratio=2, min_compact=10000):
+        '''
+        :param dirname: Directory to save the journal in
+        :param id: The site ID
+        :param compact_ratio: Growth of the journal since the last compaction that triggers a new compaction
+        :param min_compact: Minimum number of records before the journal is compacted
+        '''
+        self.dirname = dirname
+        self.filename = path.join(dirname, 'journal-[{}].jsonl'.format(id))
+        self.compact_ratio = compact_ratio
+        self.min_compact = min_compact
+        # urlids of scraped pages
+        self.scraped = set()
+        # urlid: content fingerprint of scraped pages, for content dedup
+        self.contents = {}
+        self.state = {'urlid': 1, 'eleruncnt': 0, 'linkruncnt': 0}
+        self.complete = False
+        self._pending = []
+        self._records = 0
+        self._compacted_records = 0
+        self._file = None
+
+    def _apply(self, record):
+        if record['op'] == 'link':
+            if record.get('done', False):
+                self.scraped.add(record['urlid'])
+            if 'content' in record:
+                self.contents[record['urlid']] = record['content']
+        elif record['op'] == 'done':
+            self.scraped.add(record['urlid'])
+            self.state = record['state']
+            if 'content' in record:
+                self.contents[record['urlid']] = record['content']
+        elif record['op'] == 'state':
+            self.state = record['state']
+        elif record['op'] == 'complete':
+            self.complete = True
+        else:
+            raise Exception('Unknown journal record: {}'.format(record))
+
+    def _append(self, record):
+        self._apply(record)
+        self._pending.append(json.dumps(record) + '\n')
+
+    def _links(self):
+        '''
+        Streams the link records of the journal file, in urlid order. Buffered records are not included
+        '''
+        if not path.exists(self.filename):
+            return
+        with open(self.filename, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    return
+                if record['op'] == 'link':
+                    yield record
+
+    def load(self):
+        '''
+        Replays the journal if one exists
+        :return: True if there was a journal to resume from
+        '''
+        logger = logging.getLogger(__name__ + '.load')
+        if not path.exists(self.filename):
+            return False
+        torn = False
+        with open(self.filename, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partially written last line of a crashed run
+                    logger.warning('Dropping incomplete journal record: {}'.format(line))
+                    torn = True
+                    break
+                self._apply(record)
+                self._records += 1
+        self._compacted_records = self._records
+        if torn:
+            self.compact()
+        return True
+
+    def link(self, urlid, url, depth=None):
+        '''
+        Records a newly discovered link
+        :param urlid: The urlid of the link
+        :param url: The url of the link
+        :param depth: The depth level the link will be scraped at, or None if it is not scraped
+        '''
+        self._append({'op': 'link', 'urlid': urlid, 'url': url, 'depth': depth})
+
+    def done(self, urlid, state, content=None):
+        '''
+        Records a scraped page
+        :param urlid: The urlid of the page
+        :param state: Dictionary of counters needed to resume, e.g. the next urlid
+        :param content: Optional content fingerprint of the page
+        '''
+        record = {'op': 'done', 'urlid': urlid, 'state': state}
+        if content is not None:
+            record['content'] = content
+        self._append(record)
+
+    def urls(self):
+        '''
+        :return: Generator of the urls of all links in the journal
+        '''
+        return (record['url'] for record in self._links())
+
+    def queued(self):
+        '''
+        :return: Generator of (urlid, url, depth) tuples of the links that still have to be scraped, in urlid order
+        '''
+        return ((record['urlid'], record['url'], record['depth']) for record in self._links()
+                if record['depth'] is not None and record['urlid'] not in self.scraped)
+
+    def commit(self):
+        '''
+        Writes buffered records to the journal. Should be called after the output rows of the pages are flushed
+        '''
+        if len(self._pending) == 0:
+            return
+        if self._file is None:
+            check_create_dir(self.dirname)
+            self._file = open(self.filename, 'a')
+        self._file.write(''.join(self._pending))
+        self._file.flush()
+        self._records += len(self._pending)
+        self._pending = []
+        if self._records >= max(self.min_compact, self.compact_ratio * self._compacted_records):
+            self.compact()
+
+    def compact(self):
+        '''
+        Rewrites the journal with one record per link and a single state record. Links are appended in urlid order, so
+        streaming them from the old journal keeps the order
+        '''
+        logger = logging.getLogger(__name__ + '.compact')
+        logger.debug('Compacting {0} records of {1}'.format(self._records, self.filename))
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        check_create_dir(self.dirname)
+        records = 0
+        with open(self.filename + '.tmp', 'w') as f:
+            for link in self._links():
+                record = {'op': 'link', 'urlid': link['urlid'], 'url': link['url'], 'depth': link['depth'],
+                          'done': link['urlid'] in self.scraped}
+                if record['urlid'] in self.contents:
+                    record['content'] = self.contents[record['urlid']]
+                f.write(json.dumps(record) + '\n')
+                records += 1
+            f.write(json.dumps({'op': 'state', 'state': self.state}) + '\n')
+            records += 1
+            if self.complete:
+                f.write(json.dumps({'op': 'complete'}) + '\n')
+                records += 1
+        os.replace(self.filename + '.tmp', self.filename)
+        self._records = records
+        self._compacted_records = self._records
+
+    def finish(self):
+        '''
+        Marks the site as fully scraped and closes the journal
+        '''
+        self._append({'op': 'complete'})
+        self.commit()
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
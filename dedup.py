@@ -0,0 +1,202 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+from os import path
+from sinks import check_create_dir
+
+TAG_RE = re.compile(r'<(script|style)\b.*?</\1\s*>|<[^>]*>', re.IGNORECASE | re.DOTALL)
+WORD_RE = re.compile(r'\w+')
+
+# BITS[j] maps a byte to its bit j, so the number of bytes with bit j set is a translate and a count
+BITS = [bytes((byte >> j) & 1 for byte in range(256)) for j in range(8)]
+
+
+def simhash(text, shingle=3, max_words=100000):
+    '''
+    64 bit SimHash of the words of an html page. Pages that differ in a few words have hashes that differ in a few
+    bits.
+    Every word is hashed once into one 8 byte hash per shingle position and a shingle hash is the xor of the hashes of
+    its words, computed for all shingles at once as big ints, so there is no python loop per shingle
+    :param text: Page html
+    :param shingle: Number of consecutive words hashed together
+    :param max_words: Only the first max_words words are used
+    :return: The hash as an int
+    '''
+    words = WORD_RE.findall(TAG_RE.sub(' ', text).lower())[:max_words]
+    if len(words) < shingle:
+        words = words + [''] * (shingle - len(words))
+    hashes = {word: hashlib.blake2b(word.encode('utf-8'), digest_size=8 * shingle).digest() for word in set(words)}
+    count = len(words) - shingle + 1
+    value = 0
+    for position in range(shingle):
+        parts = {word: digest[8 * position:8 * position + 8] for word, digest in hashes.items()}
+        value ^= int.from_bytes(b''.join(map(parts.__getitem__, words[position:position + count])), 'little')
+    data = value.to_bytes(8 * count, 'little')
+    result = 0
+    for i in range(8):
+        column = data[i::8]
+        for j in range(8):
+            if column.translate(BITS[j]).count(1) * 2 > count:
+                result |= 1 << (8 * i + j)
+    return result
+
+
+class ContentDedup:
+    '''
+    Detects pages whose content was already seen, by an exact hash of the body and optionally by SimHash for pages
+    that only differ in a few words, like session ids or dates.
+    Near duplicates are found with distance + 1 band indexes: two hashes within distance bits of each other are equal
+    in at least one band, so only pages sharing a band are compared
+    '''
+
+    def __init__(self, near=False, distance=3):
+        '''
+        :param near: Also detect near duplicates with SimHash
+        :param distance: Maximum number of differing SimHash bits of near duplicates
+        '''
+        self.near = near
+        self.distance = distance
+        self.bands = distance + 1
+        self.band_bits = 64 // self.bands
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self._hashes = {}
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def fingerprint(self, text):
+        '''
+        Runs on the worker threads of the concurrent engine
+        :param text: Page html
+        :return: List of [hex digest of the body, SimHash or None]
+        '''
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+        return [digest, simhash(text) if self.near else None]
+
+    def _bands(self, value):
+        mask = (1 << self.band_bits) - 1
+        return [(band, (value >> (band * self.band_bits)) & mask) for band in range(self.bands)]
+
+    def add(self, fingerprint, ref):
+        '''
+        Records the content of a page
+        :param fingerprint: Return value of fingerprint
+        :param ref: Reference to the page, returned for its duplicates
+        '''
+        with self._lock:
+            self._hashes.setdefault(fingerprint[0], ref)
+            if self.near and fingerprint[1] is not None:
+                for band in self._bands(fingerprint[1]):
+                    self._index.setdefault(band, []).append((fingerprint[1], ref))
+
+    def check(self, fingerprint, ref):
+        '''
+        Looks a page up and records it if its content is new
+        :param fingerprint: Return value of fingerprint
+        :param ref: Reference to the page
+        :return: Tuple of ('exact' or 'near', reference of the page it duplicates), or None if the page is new
+        '''
+        with self._lock:
+            original = self._hashes.get(fingerprint[0], None)
+            if original is not None:
+                self.exact_duplicates += 1
+                return 'exact', original
+            if self.near and fingerprint[1] is not None:
+                for band in self._bands(fingerprint[1]):
+                    for value, original in self._index.get(band, ()):
+                        if bin(value ^ fingerprint[1]).count('1') <= self.distance:
+                            self.near_duplicates += 1
+                            return 'near', original
+        self.add(fingerprint, ref)
+        return None
+
+    def close(self):
+        pass
+
+
+def signed(value):
+    '''
+    :return: Unsigned 64 bit value as the signed int sqlite can store
+    '''
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class SharedContentDedup(ContentDedup):
+    '''
+    ContentDedup with the hashes kept in a sqlite database, so that the worker processes of the parallel runner find
+    each other's pages. Every lookup and insert is a single transaction, so of two duplicates checked at the same time
+    by different processes exactly one is kept, the one checked first
+    '''
+
+    def __init__(self, filename, near=False, distance=3):
+        '''
+        :param filename: The sqlite database, shared by every process
+        :param near: Also detect near duplicates with SimHash
+        :param distance: Maximum number of differing SimHash bits of near duplicates
+        '''
+        super().__init__(near, distance)
+        check_create_dir(path.dirname(filename) or '.')
+        self._db = sqlite3.connect(filename, timeout=60, check_same_thread=False, isolation_level=None)
+        # The hashes are rebuilt from the journals on resume, so commits don't need to wait for the disk
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS contents (digest TEXT PRIMARY KEY, site TEXT, urlid INTEGER)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS bands (band INTEGER, value INTEGER, simhash INTEGER, site TEXT, '
+                         'urlid INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS bands_value ON bands (band, value)')
+
+    def _lookup(self, fingerprint):
+        row = self._db.execute('SELECT site, urlid FROM contents WHERE digest = ?', (fingerprint[0],)).fetchone()
+        if row is not None:
+            return 'exact', (json.loads(row[0]), row[1])
+        if self.near and fingerprint[1] is not None:
+            for band, value in self._bands(fingerprint[1]):
+                for simhash_value, site, urlid in self._db.execute(
+                        'SELECT simhash, site, urlid FROM bands WHERE band = ? AND value = ?', (band, signed(value))):
+                    if bin((simhash_value % (1 << 64)) ^ fingerprint[1]).count('1') <= self.distance:
+                        return 'near', (json.loads(site), urlid)
+        return None
+
+    def _insert(self, fingerprint, ref):
+        site = json.dumps(ref[0])
+        cursor = self._db.execute('INSERT OR IGNORE INTO contents VALUES (?, ?, ?)', (fingerprint[0], site, ref[1]))
+        if cursor.rowcount == 1 and self.near and fingerprint[1] is not None:
+            self._db.executemany('INSERT INTO bands VALUES (?, ?, ?, ?, ?)',
+                                 [(band, signed(value), signed(fingerprint[1]), site, ref[1])
+                                  for band, value in self._bands(fingerprint[1])])
+
+    def add(self, fingerprint, ref):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._insert(fingerprint, ref)
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def check(self, fingerprint, ref):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                found = self._lookup(fingerprint)
+                if found is None:
+                    self._insert(fingerprint, ref)
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+        # A page recorded by a crashed run is scraped again when the site is resumed
+        if found is None or found[1] == ref:
+            return None
+        if found[0] == 'exact':
+            self.exact_duplicates += 1
+        else:
+            self.near_duplicates += 1
+        return found
+
+    def close(self):
+        with self._lock:
+            self._db.close()
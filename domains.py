@@ -0,0 +1,164 @@
+import argparse
+import json
+import logging
+import time
+from functools import lru_cache
+from os import path
+from urllib.parse import urlsplit
+import tldextract
+
+
+def hostname(target):
+    '''
+    Cuts the hostname out of a url with plain string operations, which unlike urlsplit is cheap for urls that
+    have not been seen before
+    :param target: The url
+    :return: Lowercased hostname without user info or port
+    '''
+    start = target.find('://')
+    host = target[start + 3:] if start != -1 else target
+    for sep in '/?#':
+        end = host.find(sep)
+        if end != -1:
+            host = host[:end]
+    host = host.rpartition('@')[2]
+    if not host.startswith('['):
+        host = host.partition(':')[0]
+    return host.lower()
+
+
+class DomainParser:
+    '''
+    Splits urls into subdomain, domain and suffix without touching the network. The public suffix list is read from
+    the snapshot bundled with tldextract, or from a local snapshot file, instead of being downloaded on first use.
+    Results are memoized per hostname in a bounded LRU, so repeated links to the same host cost a dictionary lookup
+    '''
+
+    def __init__(self, suffix_list_file=None, cache_size=65536):
+        '''
+        :param suffix_list_file: Optional local copy of public_suffix_list.dat to use instead of the bundled snapshot
+        :param cache_size: Maximum number of hostnames kept in the memo
+        '''
+        suffix_list_urls = None
+        if suffix_list_file is not None:
+            suffix_list_urls = ['file://' + path.abspath(suffix_list_file)]
+        # Without cache_file, the .tld_set cache of an earlier run would be read instead of the snapshot or the file
+        self._extractor = tldextract.TLDExtract(cache_file=False, suffix_list_urls=suffix_list_urls)
+        self._extract_host = lru_cache(maxsize=cache_size)(self._extractor)
+        # The suffix list is loaded on the first lookup, do it now so it isn't charged to the first link
+        start = time.perf_counter()
+        self._extract_host('example.com')
+        self.startup = time.perf_counter() - start
+        self._extract_host.cache_clear()
+
+    def extract(self, target):
+        '''
+        :param target: The url to split
+        :return: tldextract ExtractResult with subdomain, domain and suffix
+        '''
+        return self._extract_host(hostname(target))
+
+    def domain(self, target):
+        '''
+        Extracts the domain of target url
+        :param target: The url to extract the domain of
+        :return: Extracted domain
+        '''
+        return self.extract(target).domain
+
+    def base_url(self, target):
+        '''
+        :param target: The url to get the base url of
+        :return: Base url that relative links of target are joined to. Hosts without a public suffix, like
+        localhost or ip addresses, keep their host and port as is
+        '''
+        tld_obj = self.extract(target)
+        parts = urlsplit(target)
+        scheme = parts.scheme if parts.scheme in ('http', 'https') else 'http'
+        if tld_obj.suffix == '' and parts.netloc != '':
+            return '{0}://{1}/'.format(scheme, parts.netloc)
+        return '{0}://www.{1}.{2}/'.format(scheme, tld_obj.domain, tld_obj.suffix)
+
+    def cache_info(self):
+        return self._extract_host.cache_info()
+
+
+# Parser used by get_domain and get_base_url. Created on first use, or by configure
+default_parser = None
+
+
+def configure(suffix_list_file=None, cache_size=65536):
+    '''
+    Replaces the default parser
+    :param suffix_list_file: Optional local copy of public_suffix_list.dat
+    :param cache_size: Maximum number of hostnames kept in the memo
+    :return: The new default DomainParser
+    '''
+    global default_parser
+    logger = logging.getLogger(__name__ + '.configure')
+    default_parser = DomainParser(suffix_list_file, cache_size)
+    logger.debug('Suffix list loaded in {0:.1f}ms'.format(default_parser.startup * 1000))
+    return default_parser
+
+
+def get_parser():
+    if default_parser is None:
+        configure()
+    return default_parser
+
+
+def get_domain(target):
+    '''
+    Extracts the domain of target url
+    :param target: The url to extract the domain of
+    :return: Extracted domain
+    '''
+    return get_parser().domain(target)
+
+
+def get_base_url(target):
+    return get_parser().base_url(target)
+
+
+def benchmark(urls, rounds=10, suffix_list_file=None):
+    '''
+    Measures the startup time of a parser and the cost of a domain lookup, before and after the hostnames are memoized
+    :param urls: List of urls to look up
+    :param rounds: Number of times the urls are looked up once memoized
+    :param suffix_list_file: Optional local copy of public_suffix_list.dat
+    :return: Dictionary of timings
+    '''
+    parser = DomainParser(suffix_list_file)
+    start = time.perf_counter()
+    for url in urls:
+        parser._extractor(url)
+    uncached = time.perf_counter() - start
+    start = time.perf_counter()
+    for url in urls:
+        parser.domain(url)
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for url in urls:
+            parser.domain(url)
+    cached = time.perf_counter() - start
+    info = parser.cache_info()
+    return {
+        'startupMs': parser.startup * 1000,
+        'urls': len(urls),
+        'hosts': info.currsize,
+        'uncachedCallUs': uncached / max(len(urls), 1) * 1e6,
+        'firstCallUs': first / max(len(urls), 1) * 1e6,
+        'cachedCallUs': cached / max(len(urls) * rounds, 1) * 1e6
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Domain parsing benchmark')
+    parser.add_argument('--hosts', type=int, default=100, help='Number of distinct hosts')
+    parser.add_argument('--urls', type=int, default=10000, help='Number of urls')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--suffix-list', type=str, default=None)
+    args = parser.parse_args()
+    urls = ['https://www.site{0}.co.uk/page/{1}.html'.format(i % args.hosts, i) for i in range(args.urls)]
+    print(json.dumps(benchmark(urls, args.rounds, args.suffix_list), indent=2))
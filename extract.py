@@ -0,0 +1,85 @@
+import logging
+from bs4 import SoupStrainer
+
+
+class ExtractionPlan:
+    '''
+    HTMLElementList compiled once per run. Every tag the plan needs, including the 'a' tags used for link
+    search, is collected in a single walk of the page
+    '''
+
+    def __init__(self, elementlist):
+        '''
+        :param elementlist: The list of elements on the input json string. Each entry is an element name,
+        optionally followed by ':' and a comma separated list of attributes or 'text'
+        '''
+        # (dataid, element name, targets) for every entry other than 'a' entries with targets.
+        # targets is None when only the text of the element is requested
+        self.elements = []
+        # (dataid, targets) for 'a' entries with targets. These are extracted per discovered link
+        self.links = []
+        for i, tagstring in enumerate(elementlist):
+            element_name = tagstring.split(':')[0]
+            targets = tagstring.split(':')[-1].split(',') if ':' in tagstring else None
+            if element_name == 'a' and targets is not None:
+                self.links.append((i, targets))
+            else:
+                self.elements.append((i, element_name, targets))
+        self.names = sorted(set(['a'] + [element_name for _, element_name, _ in self.elements]))
+
+    def strainer(self):
+        '''
+        :return: SoupStrainer that only builds the tags used by the plan
+        '''
+        return SoupStrainer(self.names)
+
+    def extract(self, urlid, soup):
+        '''
+        Walks the page once and extracts the data for every non link entry of the plan
+        :param urlid: The urlid of the page
+        :param soup: Reference to BeautifulSoup object
+        :return: Tuple of (list of 'a' tags, list with one list of element data dictionaries per entry)
+        '''
+        found = {name: [] for name in self.names}
+        for tag in soup.find_all(self.names):
+            found[tag.name].append(tag)
+        ret = []
+        for dataid, element_name, targets in self.elements:
+            ret.append(get_elementdata(urlid, dataid, element_name, targets, found[element_name]))
+        return found['a'], ret
+
+    def link_data(self, urlid, ele):
+        '''
+        Gets element data exclusively for 'a' tags (links)
+        :param urlid: The urlid of the page the link was found on
+        :param ele: Reference to the 'a' tag
+        :return: List of dictionaries with element data
+        '''
+        ret = []
+        for dataid, targets in self.links:
+            ret.extend(get_elementdata(urlid, dataid, 'a', targets, [ele]))
+        return ret
+
+
+def get_elementdata(urlid, dataid, element_name, targets, items):
+    '''
+    Gets data for specified element
+    :param urlid: The urlid of the element
+    :param dataid: The dataid of the element
+    :param element_name: Name of the element
+    :param targets: List of attributes or 'text' to extract. Only the text is extracted when None
+    :param items: The matching tags of the page
+    :return: List of dictionaries with element data
+    '''
+    ret = []
+    for item in items:
+        for target in targets or ['text']:
+            if target == 'text':
+                ret.append({'URLID': urlid, 'DataID': dataid, 'element': element_name, 'target': item.text})
+                continue
+            try:
+                ret.append({'URLID': urlid, 'DataID': dataid, 'element': element_name, 'target': item[target]})
+            except KeyError:
+                logging.getLogger(__name__ + '.get_elementdata').debug(
+                    'Element error: Could not find element data. Omitting')
+    return ret
@@ -0,0 +1,325 @@
+import logging
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import chardet
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util import Timeout
+from cache import CacheMiss
+
+
+class DeadlineExceeded(requests.Timeout):
+    '''
+    Raised when a page takes longer than the total deadline to download
+    '''
+
+
+class Throttled(requests.HTTPError):
+    '''
+    Raised when a server answers with 429/503
+    '''
+
+
+class SessionPool:
+    '''
+    Keeps one requests session per host so that connections are kept alive and reused across pages.
+    Sessions of the least recently used hosts are closed once more than pool_size hosts are open
+    '''
+
+    def __init__(self, pool_size=10, max_per_host=10):
+        '''
+        :param pool_size: Maximum number of hosts to keep sessions open for
+        :param max_per_host: Maximum number of connections open to a single host
+        '''
+        self.pool_size = pool_size
+        self.max_per_host = max_per_host
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        '''
+        Gets the session for the host of url, creating it if needed
+        :param url: The url that will be requested with the session
+        :return: requests.Session object
+        '''
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            session = self._sessions.get(host, None)
+            if session is not None:
+                self._sessions.move_to_end(host)
+                return session
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_per_host, pool_block=True)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._sessions[host] = session
+            if len(self._sessions) > self.pool_size:
+                _, stale = self._sessions.popitem(last=False)
+                stale.close()
+            return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+class TimeoutPolicy:
+    '''
+    Connect, read and total deadline timeouts of a fetch, and how failed fetches are retried.
+    In adaptive mode the deadlines of a domain are tightened to multiplier times the percentile of its recent fetch
+    times, so a domain that normally answers quickly does not hold a worker for the full timeout when it hangs
+    '''
+
+    def __init__(self, key, connect=10.0, read=30.0, total=120.0, retries=2, backoff=0.5, max_backoff=30.0,
+                 adaptive=False, percentile=95, multiplier=3.0, min_timeout=2.0, window=100):
+        '''
+        :param key: Function mapping a url to the domain its fetch times are tracked under
+        :param connect: Seconds to wait for a connection
+        :param read: Seconds to wait between bytes of the response
+        :param total: Seconds the whole fetch, including the body, may take
+        :param retries: Number of times a fetch that failed to connect or timed out is retried
+        :param backoff: Base of the jittered exponential wait between retries
+        :param max_backoff: Maximum wait between retries
+        :param adaptive: Tighten the deadlines of each domain based on its observed fetch times
+        :param percentile: Percentile of the fetch times the adaptive deadline is based on
+        :param multiplier: Adaptive deadline as a multiple of the percentile
+        :param min_timeout: Adaptive deadlines are never shorter than this
+        :param window: Number of recent fetch times kept per domain
+        '''
+        self.key = key
+        self.connect = connect
+        self.read = read
+        self.total = total
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.adaptive = adaptive
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_timeout = min_timeout
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def timeouts(self, url):
+        '''
+        :param url: The url about to be fetched
+        :return: Tuple of (connect, read, total) timeouts in seconds
+        '''
+        if not self.adaptive:
+            return self.connect, self.read, self.total
+        with self._lock:
+            samples = sorted(self._samples.get(self.key(url), ()))
+        if len(samples) < 10:
+            return self.connect, self.read, self.total
+        observed = samples[int(round((len(samples) - 1) * self.percentile / 100.0))]
+        total = min(self.total, max(self.min_timeout, observed * self.multiplier))
+        return min(self.connect, total), min(self.read, total), total
+
+    def observe(self, url, seconds):
+        '''
+        Records the time a successful fetch took
+        :param url: The url that was fetched
+        :param seconds: Duration of the fetch
+        '''
+        if not self.adaptive:
+            return
+        domain = self.key(url)
+        with self._lock:
+            samples = self._samples.get(domain, None)
+            if samples is None:
+                samples = deque(maxlen=self.window)
+                self._samples[domain] = samples
+            samples.append(seconds)
+
+    def wait(self, attempt):
+        '''
+        :param attempt: Number of the retry, starting at 1
+        :return: Seconds to wait before the retry, with full jitter
+        '''
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+def connect_with_timeout(session, url, headers, timeout):
+    '''
+    Sends a streamed GET and waits for the response headers
+    :param timeout: Tuple of (connect, read, total) timeouts. Connecting and waiting for the headers together take at
+    most total seconds, the body is bounded by the deadline of read_body
+    :return: The response
+    '''
+    connect, read, total = timeout
+    return session.get(url, headers=headers, stream=True,
+                       timeout=Timeout(connect=min(connect, total), read=min(read, total), total=total))
+
+
+def read_capped(response, max_bytes):
+    '''
+    Downloads at most max_bytes of a streamed response
+    :return: Tuple of (decoded body cut off at max_bytes, True if the body was truncated)
+    '''
+    logger = logging.getLogger(__name__ + '.read_capped')
+    chunks = []
+    size = 0
+    truncated = False
+    for chunk in response.iter_content(64 * 1024):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_bytes:
+            logger.warning('Body of {0} is larger than {1} bytes, truncating'.format(response.url, max_bytes))
+            truncated = True
+            break
+    body = b''.join(chunks)[:max_bytes]
+    # Same as response.text, which can't be used because it would download the rest of the body
+    encoding = response.encoding
+    if encoding is None:
+        encoding = chardet.detect(body)['encoding'] or 'utf-8'
+    return str(body, encoding, errors='replace'), truncated
+
+
+def read_body(response, deadline, max_bytes=None):
+    '''
+    Downloads the body of a streamed response, giving up at the deadline. The read timeout only bounds the gap
+    between bytes, so a server trickling the body is cut off by shutting the socket down from a timer thread
+    :param response: Streamed response
+    :param deadline: time.monotonic() value the download has to finish by
+    :param max_bytes: Maximum number of bytes downloaded, or None for no limit. Longer bodies are truncated
+    :return: Tuple of (decoded body, True if the body was truncated)
+    '''
+    expired = threading.Event()
+
+    def expire():
+        expired.set()
+        sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    timer = threading.Timer(max(0.0, deadline - time.monotonic()), expire)
+    timer.daemon = True
+    timer.start()
+    try:
+        if max_bytes is not None:
+            text, truncated = read_capped(response, max_bytes)
+        else:
+            response.content
+    except requests.RequestException as exc:
+        if expired.is_set():
+            raise DeadlineExceeded('Deadline exceeded while reading {}'.format(response.url))
+        if len(exc.args) > 0 and isinstance(exc.args[0], ReadTimeoutError):
+            raise requests.ReadTimeout(exc, request=response.request)
+        raise
+    finally:
+        timer.cancel()
+    if expired.is_set():
+        raise DeadlineExceeded('Deadline exceeded while reading {}'.format(response.url))
+    if max_bytes is not None:
+        return text, truncated
+    return response.text, False
+
+
+def fetch_once(sessions, url, headers, politeness, policy, cache=None, metrics=None, max_bytes=None):
+    '''
+    Fetches url with a single streamed GET. The body is only downloaded if the response is an html page.
+    If the page is cached the request is made conditional and the cached body is used when the server answers 304
+    :return: Page text or None if the page is not html
+    '''
+    logger = logging.getLogger(__name__ + '.fetch_once')
+    connect, read, total = policy.timeouts(url)
+    entry = cache.get(url) if cache is not None else None
+    if entry is not None and entry['text'] is not None:
+        headers = dict(headers, **cache.conditional_headers(entry))
+    response = None
+    if politeness is not None:
+        waited = time.monotonic()
+        politeness.acquire(url)
+        if metrics is not None:
+            metrics.add('wait', time.monotonic() - waited)
+    start = time.monotonic()
+    try:
+        try:
+            response = connect_with_timeout(sessions.get(url), url, headers, (connect, read, total))
+        finally:
+            if metrics is not None:
+                metrics.add('fetch', time.monotonic() - start)
+        try:
+            # Throttling is detected from the headers, the request slot is only freed once the body is read
+            if politeness is not None and politeness.observe(url, response):
+                raise Throttled('Throttled with status {}'.format(response.status_code), response=response)
+            if entry is not None and response.status_code == 304:
+                logger.debug('Not modified, using cached page: %s', url)
+                return entry['text']
+            content_type = response.headers['content-type']
+            if content_type.split(';')[0] != 'text/html':
+                logger.info('Skipping due to invalid mime type: %s', content_type)
+                if cache is not None and response.status_code == 200:
+                    cache.put(url, response, None)
+                return None
+            downloading = time.monotonic()
+            text, truncated = read_body(response, start + total, max_bytes)
+            policy.observe(url, time.monotonic() - start)
+            if metrics is not None:
+                metrics.add('download', time.monotonic() - downloading)
+                metrics.latency(time.monotonic() - start)
+            # A truncated page would be served as complete by later revalidations and replays
+            if cache is not None and response.status_code == 200 and not truncated:
+                cache.put(url, response, text)
+            return text
+        finally:
+            response.close()
+    finally:
+        if politeness is not None:
+            politeness.release(url)
+
+
+def fetch_html(sessions, url, headers, politeness=None, policy=None, throttle_retries=3, cache=None, replay=False,
+               metrics=None, max_bytes=None):
+    '''
+    Fetches url, retrying connection errors and timeouts with jittered exponential backoff, and throttled
+    requests once the domain's politeness backoff has passed
+    :param sessions: SessionPool to take the session from
+    :param url: The url to fetch
+    :param headers: Request headers
+    :param politeness: Optional PolitenessScheduler limiting the requests sent to each domain
+    :param policy: TimeoutPolicy of the fetch. Defaults to a policy without adaptive timeouts
+    :param throttle_retries: Number of times a throttled (429/503) request is retried
+    :param cache: Optional ResponseCache to revalidate and save pages with
+    :param replay: Only read pages from cache, without touching the network
+    :param metrics: Optional StageMetrics to add the wait, fetch and download times to
+    :param max_bytes: Maximum number of bytes of a page that are downloaded, or None for no limit
+    :return: Page text or None if the page is not html
+    '''
+    logger = logging.getLogger(__name__ + '.fetch_html')
+    if replay:
+        entry = cache.get(url)
+        if entry is None:
+            raise CacheMiss('Not in cache: {}'.format(url))
+        if entry['text'] is None:
+            logger.info('Skipping due to invalid mime type: %s', entry['content_type'])
+        return entry['text']
+    if policy is None:
+        policy = TimeoutPolicy(None)
+    attempt = 0
+    throttles = 0
+    while True:
+        try:
+            return fetch_once(sessions, url, headers, politeness, policy, cache, metrics, max_bytes)
+        except Throttled:
+            if throttles == throttle_retries:
+                raise
+            throttles += 1
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            if attempt == policy.retries:
+                raise
+            attempt += 1
+            wait = policy.wait(attempt)
+            logger.info('Retrying {0} in {1:.2f}s after: {2}'.format(url, wait, exc))
+            time.sleep(wait)
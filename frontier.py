@@ -0,0 +1,283 @@
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import os
+import tempfile
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    '''
+    Canonicalizes a url so that trivially different spellings of the same page compare equal.
+    Lowercases the scheme and host, drops 'www.', default ports, fragments and trailing slashes
+    :param url: The url to normalize
+    :return: Normalized url, or the stripped url if it can't be parsed, e.g. with a broken IPv6 host
+    '''
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url.strip()
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port is not None and port != DEFAULT_PORTS.get(scheme, None):
+        host = '{0}:{1}'.format(host, port)
+    urlpath = parts.path.rstrip('/') or '/'
+    return urlunsplit((scheme, host, urlpath, parts.query, ''))
+
+
+class BloomFilter:
+    '''
+    Fixed size probabilistic set. Membership checks can return false positives at roughly error_rate
+    but never false negatives, and memory use does not grow with the number of items added
+    '''
+
+    def __init__(self, capacity, error_rate=0.001):
+        '''
+        :param capacity: Number of items the filter is sized for
+        :param error_rate: Target false positive rate at capacity
+        '''
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class URLFrontier:
+    '''
+    Keeps track of every url seen during a scrape. Urls are deduplicated on their normalized form with a hash set,
+    or with a BloomFilter for very large scrapes
+    '''
+
+    def __init__(self, bloom=False, capacity=1000000, error_rate=0.001):
+        '''
+        :param bloom: Use a BloomFilter instead of a set. Some new urls may be wrongly treated as seen
+        :param capacity: Number of urls the BloomFilter is sized for
+        :param error_rate: False positive rate of the BloomFilter
+        '''
+        self.seen = BloomFilter(capacity, error_rate) if bloom else set()
+        self.added = 0
+        self.deduplicated = 0
+
+    def add(self, url):
+        '''
+        Adds url to the frontier if it hasn't been seen before
+        :param url: The url to add
+        :return: True if the url is new, False if it is a duplicate
+        '''
+        key = normalize_url(url)
+        if key in self.seen:
+            self.deduplicated += 1
+            return False
+        self.seen.add(key)
+        self.added += 1
+        return True
+
+    def __contains__(self, url):
+        return normalize_url(url) in self.seen
+
+    def __len__(self):
+        return self.added
+
+
+class PriorityScheduler:
+    '''
+    Priority queue of the urls waiting to be scraped. Urls are scored once when they are pushed by the number of
+    priority strings they contain, weighted by weights, and popped highest score first.
+    Without a depth_penalty urls are popped depth level by depth level, ordered by score within a level.
+    With a depth_penalty, depth * depth_penalty is subtracted from the score and urls of every depth level
+    compete with each other, so high value pages deep in the site are scraped early.
+    With max_memory set, the lowest priority half of the queue is written to a sorted run file in spill_dir whenever
+    more than max_memory urls are queued in memory. Runs are merged back in priority order as urls are popped, with
+    only the next url of every run kept in memory. Every run keeps a file open, so once there are max_runs runs they
+    are merged into a single one
+    '''
+
+    def __init__(self, pstrings, weights=None, depth_penalty=None, max_depth=None, max_memory=None, spill_dir=None,
+                 max_runs=16):
+        '''
+        :param pstrings: List of priority strings
+        :param weights: Optional dictionary of priority string to weight. Priority strings default to a weight of 1
+        :param depth_penalty: Score subtracted per depth level, or None to scrape level by level
+        :param max_depth: Urls pushed for a deeper level are counted but not queued
+        :param max_memory: Maximum number of queued urls kept in memory, or None to keep all of them
+        :param spill_dir: Directory for the run files. Defaults to the system temp directory
+        :param max_runs: Maximum number of run files
+        '''
+        self.weights = {pstr.strip().lower(): 1.0 for pstr in pstrings if pstr.strip() != ''}
+        for pstr, weight in (weights or {}).items():
+            self.weights[pstr.strip().lower()] = float(weight)
+        self.depth_penalty = depth_penalty
+        self.max_depth = max_depth
+        # Number of urls pushed for each depth level
+        self.pushed = {}
+        self._heap = []
+        self._counter = itertools.count()
+        # Urls that have been popped but not marked done yet
+        self.inflight = OrderedDict()
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.max_runs = max_runs
+        # Heap of (next entry, run) of the run files. A run is [file, path, next entry, entries left in the file]
+        self._runs = []
+        self.spilled = 0
+
+    def score(self, url):
+        '''
+        :param url: The url to score
+        :return: Sum of the weights of the priority strings found in url
+        '''
+        url = url.lower()
+        return sum(weight for pstr, weight in self.weights.items() if pstr in url)
+
+    def push(self, urlid, url, depth):
+        '''
+        Adds a url to the queue
+        :param urlid: The urlid of the url
+        :param url: The url to scrape
+        :param depth: The depth level the url will be scraped at
+        :return: Score of the url, or None if depth is past max_depth
+        '''
+        self.pushed[depth] = self.pushed.get(depth, 0) + 1
+        if self.max_depth is not None and depth > self.max_depth:
+            return None
+        score = self.score(url)
+        if self.depth_penalty is None:
+            key = (depth, -score, next(self._counter))
+        else:
+            key = (depth * self.depth_penalty - score, next(self._counter))
+        heapq.heappush(self._heap, (key, urlid, url, depth))
+        if self.max_memory is not None and len(self._heap) > self.max_memory:
+            self._spill()
+        return score
+
+    def _spill(self):
+        '''
+        Moves the lowest priority half of the in memory queue to a new run file, merged with the existing runs once
+        there are max_runs of them
+        '''
+        entries = sorted(self._heap)
+        keep = len(entries) // 2
+        self._heap = entries[:keep]
+        self.spilled += len(entries) - keep
+        spill = entries[keep:]
+        if len(self._runs) >= self.max_runs:
+            runs = [run for _, _, run in self._runs]
+            self._runs = []
+            self._write_run(heapq.merge(spill, *[self._read_run(run) for run in runs]))
+            for run in runs:
+                run[0].close()
+                os.remove(run[1])
+        else:
+            self._write_run(spill)
+
+    def _write_run(self, entries):
+        '''
+        Writes sorted entries to a new run file and puts its first entry on the run heap
+        '''
+        fd, filename = tempfile.mkstemp(prefix='frontier-', suffix='.jsonl', dir=self.spill_dir)
+        count = 0
+        with os.fdopen(fd, 'w') as f:
+            for key, urlid, url, depth in entries:
+                f.write(json.dumps([key, urlid, url, depth]) + '\n')
+                count += 1
+        self._advance([open(filename, 'rb'), filename, None, count])
+
+    def _read_run(self, run):
+        '''
+        :return: Generator of the entries left in a run, starting with the one on the run heap
+        '''
+        yield run[2]
+        for _ in range(run[3]):
+            key, urlid, url, depth = json.loads(run[0].readline())
+            yield tuple(key), urlid, url, depth
+
+    def _advance(self, run):
+        '''
+        Reads the next entry of a run onto the run heap, or deletes the run file once it is used up
+        '''
+        if run[3] == 0:
+            run[0].close()
+            os.remove(run[1])
+            return
+        key, urlid, url, depth = json.loads(run[0].readline())
+        run[2] = (tuple(key), urlid, url, depth)
+        run[3] -= 1
+        heapq.heappush(self._runs, (run[2], id(run), run))
+
+    def _from_runs(self):
+        return len(self._runs) > 0 and (len(self._heap) == 0 or self._runs[0][0] < self._heap[0])
+
+    def ahead_of(self, depth):
+        '''
+        Checks whether the next url can be fetched while a page at depth is still being processed, i.e. whether no url
+        that page can queue would be popped before it
+        :param depth: Depth of the page being processed
+        :return: True if the next url is popped before any url queued by the page, False if it isn't or the queue is
+        empty
+        '''
+        if self._from_runs():
+            key = self._runs[0][0][0]
+        elif len(self._heap) > 0:
+            key = self._heap[0][0]
+        else:
+            return False
+        # Urls queued later lose ties on the push counter
+        if self.depth_penalty is None:
+            return key[0] <= depth
+        max_score = sum(weight for weight in self.weights.values() if weight > 0)
+        return key[0] <= (depth + 1) * self.depth_penalty - max_score
+
+    def pop(self):
+        '''
+        Takes the highest priority url off the queue. It stays in inflight until done() is called with its urlid
+        :return: Tuple of (urlid, url, depth) or None if the queue is empty
+        '''
+        if self._from_runs():
+            entry, _, run = heapq.heappop(self._runs)
+            self._advance(run)
+        elif len(self._heap) > 0:
+            entry = heapq.heappop(self._heap)
+        else:
+            return None
+        _, urlid, url, depth = entry
+        self.inflight[urlid] = (urlid, url, depth)
+        return urlid, url, depth
+
+    def done(self, urlid):
+        self.inflight.pop(urlid, None)
+
+    def close(self):
+        '''
+        Deletes the run files
+        '''
+        for _, _, run in self._runs:
+            run[0].close()
+            os.remove(run[1])
+        self._runs = []
+
+    def __len__(self):
+        return len(self._heap) + sum(run[3] + 1 for _, _, run in self._runs) + len(self.inflight)
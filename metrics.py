@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+# Stages of scraping a page, in the order they happen
+STAGES = ('wait', 'fetch', 'download', 'parse', 'links', 'elements', 'write', 'status')
+
+
+def peak_rss():
+    '''
+    :return: Peak resident memory of this process in MB
+    '''
+    # VmHWM starts over at exec, ru_maxrss can include the memory of the process that started this one
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == 'darwin' else maxrss / 1024
+
+
+class StageMetrics:
+    '''
+    Accumulates the time spent in every stage of scraping a page. Fetch stages are timed on the worker threads of
+    the concurrent engine, so add() is thread safe.
+    Every interval seconds a stats line is logged and a json line with the cumulative totals is appended to filename
+    '''
+
+    def __init__(self, interval=30.0, filename=None, window=10000):
+        '''
+        :param interval: Seconds between stats lines
+        :param filename: File to append the json metrics to, or None to only log them
+        :param window: Number of recent page latencies percentiles are computed from
+        '''
+        self.interval = interval
+        self.filename = filename
+        self.pages = 0
+        self.totals = {stage: 0.0 for stage in STAGES}
+        self.counts = {stage: 0 for stage in STAGES}
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last_report = self._start
+
+    def add(self, stage, seconds):
+        '''
+        :param stage: One of STAGES
+        :param seconds: Time spent in the stage
+        '''
+        with self._lock:
+            self.totals[stage] += seconds
+            self.counts[stage] += 1
+
+    def latency(self, seconds):
+        '''
+        Records the time it took to fetch and download a page
+        '''
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def page(self):
+        '''
+        Counts a scraped page and reports the stats once interval seconds have passed since the last report
+        '''
+        self.pages += 1
+        if time.monotonic() - self._last_report >= self.interval:
+            self.report()
+
+    def snapshot(self):
+        '''
+        :return: Dictionary of the cumulative metrics of this process
+        '''
+        with self._lock:
+            latencies = sorted(self._latencies)
+            totals = dict(self.totals)
+            counts = dict(self.counts)
+        elapsed = time.monotonic() - self._start
+
+        def percentile(pct):
+            if len(latencies) == 0:
+                return None
+            return latencies[int(round((len(latencies) - 1) * pct / 100.0))] * 1000
+
+        return {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'pid': os.getpid(),
+            'elapsed': elapsed,
+            'pages': self.pages,
+            'pagesPerSec': self.pages / max(elapsed, 0.001),
+            'latencyP50Ms': percentile(50),
+            'latencyP99Ms': percentile(99),
+            'peakRssMB': peak_rss(),
+            'stages': {stage: {'count': counts[stage], 'seconds': totals[stage],
+                               'msPerPage': totals[stage] / max(self.pages, 1) * 1000} for stage in STAGES}
+        }
+
+    def report(self, final=False):
+        '''
+        Logs a stats line and appends the metrics to filename
+        :param final: Marks the last report of the process
+        '''
+        logger = logging.getLogger(__name__ + '.report')
+        self._last_report = time.monotonic()
+        snapshot = self.snapshot()
+        snapshot['final'] = final
+        stages = ', '.join('{0} {1:.1f}'.format(stage, values['msPerPage'])
+                           for stage, values in snapshot['stages'].items())
+        logger.info('Stats: {0} pages, {1:.1f} pages/sec, latency p50 {2:.1f}ms p99 {3:.1f}ms, peak rss {4:.0f}MB, '
+                    'ms per page: {5}'.format(snapshot['pages'], snapshot['pagesPerSec'], snapshot['latencyP50Ms'] or 0,
+                                              snapshot['latencyP99Ms'] or 0, snapshot['peakRssMB'], stages))
+        if self.filename is not None:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
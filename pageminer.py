@@ -1,161 +1,430 @@
 import argparse
 import logging
 import json
-import requests
-import os
-import csv
+import multiprocessing
+import time
 from os import path
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from sys import stdout
 from datetime import datetime
-import tldextract
-import timeout_decorator
+import requests
 from bs4 import BeautifulSoup
+from fetcher import SessionPool, TimeoutPolicy, fetch_html
+from politeness import PolitenessScheduler
+from extract import ExtractionPlan
+from frontier import URLFrontier, PriorityScheduler
+from sinks import make_sink, check_create_dir
+from checkpoint import CheckpointJournal
+from cache import ResponseCache
+from metrics import StageMetrics
+from dedup import ContentDedup, SharedContentDedup
+import domains
+from domains import get_domain, get_base_url
 
 
-def check_create_dir(dirname):
+def fetch_page(sessions, politeness, policy, url, headers, features='html.parser', parse_only=None,
+               throttle_retries=3, cache=None, replay=False, metrics=None, max_bytes=None, fingerprint=None):
     '''
-    Checks if directory exists and if it doesn't creates a new directory
-    :param dirname: Path to directory
+    Fetches url and parses it if it is an html page. Runs on the worker threads of the concurrent engine
+    :param sessions: SessionPool to fetch with
+    :param politeness: PolitenessScheduler limiting the requests sent to each domain
+    :param policy: TimeoutPolicy with the timeouts and retries of the fetch
+    :param url: The url to fetch
+    :param headers: Request headers
+    :param features: BeautifulSoup parser backend
+    :param parse_only: Optional SoupStrainer limiting the tags that are built
+    :param throttle_retries: Number of times a throttled request is retried
+    :param cache: Optional ResponseCache
+    :param replay: Only read pages from cache
+    :param metrics: Optional StageMetrics to add the fetch and parse times to
+    :param max_bytes: Maximum number of bytes of the page that are downloaded and parsed
+    :param fingerprint: Optional function returning the content fingerprint of the page text
+    :return: Tuple of (BeautifulSoup object, None, fingerprint), (None, None, None) if the page is not html or
+    (None, exception, None)
     '''
-    if not path.exists(dirname):
-        if '/' in dirname:
-            os.makedirs(dirname)
-        else:
-            os.mkdir(dirname)
+    try:
+        text = fetch_html(sessions, url, headers, politeness, policy, throttle_retries, cache, replay, metrics,
+                          max_bytes)
+        if text is None:
+            return None, None, None
+        start = time.perf_counter()
+        content = fingerprint(text) if fingerprint is not None else None
+        soup = BeautifulSoup(text, features, parse_only=parse_only)
+        if metrics is not None:
+            metrics.add('parse', time.perf_counter() - start)
+        return soup, None, content
+    except Exception as exc:
+        return None, exc, None
 
 
-def get_domain(target):
+def fetch_ordered(scheduler, fetch, executor=None, window=1):
     '''
-    Extracts the domain of target url
-    :param target: The url to extract the domain of
-    :return: Extracted domain
+    Fetches the scheduler's urls, concurrently if an executor is given. Results are yielded in the order the urls
+    were popped so that URLID assignment is the same on every run with the same settings.
+    The window is only refilled with urls that no page still pending can queue a higher priority url in front of, so
+    the urls are popped in the same order as a sequential scrape
+    :param scheduler: PriorityScheduler to pop (urlid, url, depth) tuples from
+    :param fetch: Function taking a url and returning a (soup, exception, fingerprint) tuple
+    :param executor: ThreadPoolExecutor to fetch with. Fetches sequentially when None
+    :param window: Maximum number of pages fetched ahead of the one being processed
+    :return: Generator of ((urlid, url, depth), (soup, exception, fingerprint)) tuples
     '''
-    return tldextract.extract(target).domain
+    if executor is None:
+        entry = scheduler.pop()
+        while entry is not None:
+            yield entry, fetch(entry[1])
+            entry = scheduler.pop()
+        return
+    pending = deque()
+    while True:
+        while len(pending) < window:
+            if len(pending) > 0 and not scheduler.ahead_of(min(entry[2] for entry, _ in pending)):
+                break
+            entry = scheduler.pop()
+            if entry is None:
+                break
+            pending.append((entry, executor.submit(fetch, entry[1])))
+        if len(pending) == 0:
+            return
+        entry, future = pending.popleft()
+        yield entry, future.result()
 
 
-def get_base_url(target):
-    tld_obj = tldextract.extract(target)
-    if 'https' in target:
-        return 'https://www.{0}.{1}/'.format(tld_obj.domain, tld_obj.suffix)
-    else:
-        return 'http://www.{0}.{1}/'.format(tld_obj.domain, tld_obj.suffix)
-
-
-def get_elementdata(urlid, dataid, tagstring, soup):
+def init_resources(data):
     '''
-    Gets data for specified element
-    :param urlid: The urlid of the element
-    :param dataid: The dataid of the element
-    :param tagstring: The tagstring describing the element and the specific content of the element
-    :param soup: Reference to BeautifulSoup object
-    :return: List of dictionaries with element data
+    Creates the resources shared by every site scraped in a process
+    :param data: The input json
+    :return: Dictionary of resources
     '''
-    logger = logging.getLogger(__name__ + '.get_elementdata')
-    ret = []
-    element_name = tagstring.split(':')[0]
-    for item in soup.find_all(element_name):
-        if ':' not in tagstring:
-            logger.debug('Scanning: {}-text'.format(element_name))
-            ret.append({'URLID': urlid, 'DataID': dataid, 'element': element_name, 'target': item.text})
+    logger = logging.getLogger(__name__ + '.init_resources')
+    # Domains are parsed offline from a suffix list snapshot and memoized per hostname
+    domains.configure(data.get('suffixListFile', None), int(data.get('domainCacheSize', 65536)))
+    # Init concurrent engine. Pages are fetched on a thread pool when 'concurrency' is above 1
+    concurrency = int(data.get('concurrency', 1))
+    executor = None
+    if concurrency > 1:
+        logger.info('Concurrent engine enabled with {} workers'.format(concurrency))
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+    # HTMLElementList is compiled once into a plan that extracts every page in a single tree walk
+    plan = ExtractionPlan(data['HTMLElementList'])
+    # Optional on-disk cache of fetched pages, revalidated with conditional requests or replayed offline
+    cache = None
+    if data.get('cacheDir', None) is not None:
+        cache = ResponseCache(data['cacheDir'], int(float(data.get('cacheSize', 1024)) * 1024 * 1024))
+    elif data.get('cacheMode', 'revalidate') == 'replay':
+        raise Exception('cacheMode replay needs a cacheDir')
+    # Time spent in every stage of a page, logged and saved to the metrics file every statsInterval seconds
+    metrics = StageMetrics(float(data.get('statsInterval', 30)),
+                           data.get('metricsFile', path.join('logs', 'metrics.jsonl')))
+    # Pages with content already seen in the same site, or in any site, are not extracted again.
+    # Worker processes of the parallel runner share the hashes of every site through a sqlite database
+    dedup = None
+    if data.get('contentDedup', False) and data.get('dedupScope', 'site') == 'all':
+        if int(data.get('processes', 1)) > 1:
+            dedup = SharedContentDedup(path.join('status', 'dedup.db'), data.get('simhash', False),
+                                       int(data.get('simhashDistance', 3)))
         else:
-            targets = tagstring.split(':')[-1]
-            for target in targets.split(','):
-                if target == 'text':
-                    logger.debug('Scanning: {}-text'.format('a'))
-                    ret.append({'URLID': urlid, 'DataID': i - 1, 'element': 'a', 'target': ele.text})
-                    continue
-                logger.debug('Scanning: {0}-{1}'.format(element_name, target))
-                try:
-                    ret.append({'URLID': urlid, 'DataID': dataid, 'element': element_name, 'target': item['target']})
-                except KeyError:
-                    logger.debug('Element error: Could not find element data. Omitting')
-    return ret
+            dedup = new_dedup(data)
+    # Per domain limits are off when not set
+    host_rate = float(data['hostRate']) if data.get('hostRate', None) is not None else None
+    host_max_inflight = int(data['hostMaxInFlight']) if data.get('hostMaxInFlight', None) is not None else None
+    return {
+        'concurrency': concurrency,
+        'executor': executor,
+        # Connections are pooled per host and kept alive across pages
+        'sessions': SessionPool(int(data.get('poolSize', 10)), int(data.get('poolMaxPerHost', 10))),
+        # Requests are rate limited per domain and back off when a site answers with 429/503
+        'politeness': PolitenessScheduler(get_domain, host_rate, int(data.get('hostBurst', 1)), host_max_inflight,
+                                          float(data.get('backoff', 1)), float(data.get('maxBackoff', 300))),
+        'throttleRetries': int(data.get('throttleRetries', 3)),
+        # Every fetch has connect, read and total deadlines and is retried on connection errors and timeouts
+        'policy': TimeoutPolicy(get_domain, float(data.get('connectTimeout', 10)), float(data.get('readTimeout', 30)),
+                                float(data.get('totalTimeout', 120)), int(data.get('retries', 2)),
+                                float(data.get('retryBackoff', 0.5)), float(data.get('maxRetryBackoff', 30)),
+                                data.get('adaptiveTimeouts', False), float(data.get('adaptivePercentile', 95)),
+                                float(data.get('adaptiveMultiplier', 3)), float(data.get('adaptiveMinTimeout', 2))),
+        'plan': plan,
+        'cache': cache,
+        'replay': data.get('cacheMode', 'revalidate') == 'replay',
+        'features': data.get('parser', 'html.parser'),
+        'maxBodySize': int(data['maxBodySize']) if data.get('maxBodySize', None) is not None else None,
+        'strainer': plan.strainer() if data.get('soupStrainer', False) else None,
+        # Output rows are buffered and flushed on size, time and before every checkpoint.
+        # csv by default, or compressed json lines or parquet
+        'sink': make_sink(data.get('outputFormat', 'csv'), data['saveFileDir'], data.get('outputCompression', None),
+                          data.get('flushRows', None), data.get('flushSeconds', None), metrics),
+        'metrics': metrics,
+        'dedup': dedup
+    }
 
 
-def get_linkdata(urlid, elementlist, ele):
+def new_dedup(data):
     '''
-    Get element data exclusively for 'a' tags (links)
-    :param urlid: The urlid of the element
-    :param elementlist: The list of elements on the input json string
-    :param ele: Reference to BeautifulSoup object
-    :return: List of dictionaries with element data
+    :param data: The input json
+    :return: ContentDedup configured by the input, or None if content dedup is off
     '''
-    logger = logging.getLogger(__name__ + '.getlinkdata')
-    ret = []
-    for i, tagstring in enumerate(elementlist):
-        if 'a:' in tagstring:
-            if ':' not in tagstring:
-                logger.debug('Scanning: {}-text'.format('a'))
-                ret.append({'URLID': urlid, 'DataID': i, 'element': 'a', 'target': ele.text})
-            else:
-                targets = tagstring.split(':')[-1]
-                for target in targets.split(','):
-                    if target == 'text':
-                        logger.debug('Scanning: {}-text'.format('a'))
-                        ret.append({'URLID': urlid, 'DataID': i, 'element': 'a', 'target': ele.text})
-                        continue
-                    logger.debug('Scanning: {0}-{1}'.format('a', target))
-                    try:
-                        ret.append({'URLID': urlid, 'DataID': i, 'element': 'a', 'target': ele['href']})
-                    except KeyError:
-                        logger.debug('Element ERROR: Could not find element data. Omitting')
-        else:
-            logger.debug('Could not find tag')
-    return ret
+    if not data.get('contentDedup', False):
+        return None
+    return ContentDedup(data.get('simhash', False), int(data.get('simhashDistance', 3)))
 
 
-def connect_with_timeout(url, headers):
-    return requests.get(url, headers=headers)
+def close_resources(resources):
+    logger = logging.getLogger(__name__ + '.close_resources')
+    if resources['executor'] is not None:
+        resources['executor'].shutdown()
+    resources['sessions'].close()
+    resources['sink'].close()
+    if resources['cache'] is not None:
+        logger.info('Cache: {0} pages found, {1} not cached'.format(resources['cache'].hits, resources['cache'].misses))
+        resources['cache'].close()
+    if resources['dedup'] is not None:
+        resources['dedup'].close()
+    resources['metrics'].report(final=True)
 
 
-def update_csv(id, savedir, write_data, datatype, runcnt):
-    logger = logging.getLogger(__name__ + '.update_csv')
-    logger.debug('Writing to csv. Runcount = {0}, Type: {1}'.format(runcnt, datatype))
-    if not isinstance(write_data, list):
-        write_data = [write_data]
-    if len(write_data) == 0:
-        logger.warning('Nothing to write')
+def scrape_site(item, data, resources, progress=None):
+    '''
+    Scrapes a single runURL entry, writing its output and journal
+    :param item: The runURL entry
+    :param data: The input json
+    :param resources: Dictionary from init_resources
+    :param progress: Optional shared counter of pages scraped across all processes
+    :return: Number of pages scraped
+    '''
+    logger = logging.getLogger(__name__ + '.scrape_site')
+    sessions = resources['sessions']
+    politeness = resources['politeness']
+    executor = resources['executor']
+    concurrency = resources['concurrency']
+    plan = resources['plan']
+    features = resources['features']
+    strainer = resources['strainer']
+    sink = resources['sink']
+    metrics = resources['metrics']
+    # Dedup index shared by every site, or a new one for this site
+    dedup = resources['dedup'] if resources['dedup'] is not None else new_dedup(data)
+    if dedup is not None:
+        dedup_counts = (dedup.exact_duplicates, dedup.near_duplicates)
+    # Per link logs are only formatted when debug logging is on
+    debug = logger.isEnabledFor(logging.DEBUG)
+    pages = 0
+    logger.info('Item level Id: {}'.format(item['ID']))
+    # Init variables
+    eleruncnt = 0
+    linkruncnt = 0
+    start_time = datetime.now()
+    priority_strings = data['pstrings'].split(',')
+    urlid = 1
+    urls = [(0, item['URL'], 0)]
+    all_urls = URLFrontier(data.get('bloomFilter', False), int(data.get('bloomCapacity', 1000000)),
+                           float(data.get('bloomErrorRate', 0.001)))
+    all_urls.add(item['URL'])
+    home_domain = get_domain(item['URL'])
+    base_url = get_base_url(item['URL'])
+    # If a journal already exists, continue from the last scraped page
+    journal = CheckpointJournal('status', item['ID'], min_compact=int(data.get('journalCompact', 10000)))
+    if journal.load():
+        if dedup is not None:
+            for content_id, content in journal.contents.items():
+                dedup.add(content, (item['ID'], content_id))
+        if journal.complete:
+            logger.info('Entry {} already complete. Skipping'.format(item['ID']))
+            return 0
+        logger.info('Existing journal found, continuing scrape')
+        urlid = journal.state['urlid']
+        eleruncnt = journal.state['eleruncnt']
+        linkruncnt = journal.state['linkruncnt']
+        for link_url in journal.urls():
+            all_urls.add(link_url)
+        urls = journal.queued()
     else:
-        if datatype == 'element':
-            save_file = 'tempData-[{}].csv'.format(id)
-        elif datatype == 'url':
-            save_file = 'tempUrl-[{}].csv'.format(id)
+        logger.info('No existing journal found. Starting from the beginning')
+        journal.link(0, item['URL'], 0)
+    # Priority check: urls are scored on their priority strings when queued and scraped highest score first
+    # Past frontierMemory queued urls, the lowest priority ones are spilled to disk
+    scheduler = PriorityScheduler(priority_strings, data.get('pweights', None), data.get('depthPenalty', None),
+                                  data['depth'], data.get('frontierMemory', None), data.get('spillDir', None))
+    for entry in urls:
+        scheduler.push(*entry)
+
+    logger.info('Starting scrape process')
+    headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36'
+                             ' (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36'}
+    fetch = partial(fetch_page, sessions, politeness, resources['policy'], headers=headers, features=features,
+                    parse_only=strainer, throttle_retries=resources['throttleRetries'], cache=resources['cache'],
+                    replay=resources['replay'], metrics=metrics, max_bytes=resources['maxBodySize'],
+                    fingerprint=dedup.fingerprint if dedup is not None else None)
+    fetched = fetch_ordered(scheduler, fetch, executor, concurrency * 2)
+    current_depth = None
+    for urlno, ((uid, url, depth), (soup, exc, content)) in enumerate(fetched):
+        if depth != current_depth:
+            logger.info('------------------------ Depth {} -------------------------'.format(depth))
+            current_depth = depth
+        logger.info('urls level urlno: %s, ele: %s', urlno, (uid, url))
+        # Content dedup runs in pop order, so the page kept is the same on every run
+        duplicate = None
+        if soup is not None and content is not None:
+            duplicate = dedup.check(content, (item['ID'], uid))
+
+        if isinstance(exc, requests.Timeout):
+            logger.error('Connection timeout error. Omitting')
+            ele_write_data = {'URLID': uid, 'url': url, 'depth': depth,
+                 'Connection error': 'The website was connected to but it took too long to retrieve data.'}
+            sink.write(item['ID'], ele_write_data, 'element', eleruncnt)
+            eleruncnt += 1
+        elif exc is not None:
+            logger.error('Connection error: %s  Omitting', exc)
+            ele_write_data = {'URLID': uid, 'url': url, 'depth': depth, 'Connection error': str(exc)}
+            sink.write(item['ID'], ele_write_data, 'element', eleruncnt)
+            eleruncnt += 1
+        elif soup is None:
+            # Not an html page
+            pass
+        elif duplicate is not None:
+            # Only a reference to the page with the same content is saved, its links are not followed
+            kind, (dup_id, dup_urlid) = duplicate
+            logger.info('Duplicate (%s) of %s URLID %s. Omitting', kind, dup_id, dup_urlid)
+            ele_write_data = {'URLID': uid, 'url': url, 'depth': depth, 'duplicate': kind, 'duplicateOf': dup_urlid,
+                              'duplicateSite': str(dup_id)}
+            sink.write(item['ID'], ele_write_data, 'element', eleruncnt)
+            eleruncnt += 1
+            soup.decompose()
+            soup = None
         else:
-            raise Exception('Unknown type')
-        check_create_dir(savedir)
-        with open(path.join(savedir, save_file), 'a') as writefile:
-            writer = csv.DictWriter(writefile, fieldnames=list(write_data[0].keys()) + ['error'], restval='n/a')
-            if runcnt == 0:
-                logger.debug('Writing header')
-                writer.writeheader()
-            for ele in write_data:
-                if ele.get('target', None) is not None and '\n' in ele['target']:
-                    ele['target'] = ele['target'].replace('\n', 'N%%L')
-                writer.writerow(ele)
+            start = time.perf_counter()
+            anchors, element_data = plan.extract(uid, soup)
+            metrics.add('elements', time.perf_counter() - start)
+            # Link search routine. Time spent writing rows is counted as write time
+            start = time.perf_counter()
+            written = metrics.totals['write']
+            for ele in anchors:
+                if data.get('limit', None) is not None and scheduler.pushed.get(depth + 1, 0) == data['limit']:
+                    # 'limit' entry on the input json is used only for debug purposes.
+                    # This part is omitted when not included.
+                    break
+                # Make sure element points to valid link
+                if ele.get('href', None) is not None:
+                    raw_link = ele['href'].strip()
+                    if 'http' not in raw_link:
+                        if raw_link.startswith('/'):
+                            processed_url = (base_url + raw_link[1:]).strip()
+                            if all_urls.add(processed_url):
+                                urlid += 1
+                                if debug:
+                                    logger.debug('Adding to queue: %s', (urlid, processed_url))
+                                scheduler.push(urlid, processed_url, depth + 1)
+                                journal.link(urlid, processed_url, depth + 1)
+                                url_write_data = {'URLID': urlid, 'depth': depth, 'url': processed_url}
+                                sink.write(item['ID'], url_write_data, 'url', linkruncnt)
+                                linkruncnt += 1
+                                # If 'a' is present in HTMLElementList, add its data onto element_data
+                                ele_write_data = plan.link_data(uid, ele)
+                                sink.write(item['ID'], ele_write_data,
+                                           'element', eleruncnt)
+                                eleruncnt += 1
 
+                        else:
+                            processed_url = (base_url + raw_link).strip()
+                            if all_urls.add(processed_url):
+                                urlid += 1
+                                if debug:
+                                    logger.debug('Adding to queue: %s', (urlid, processed_url))
+                                scheduler.push(urlid, processed_url, depth + 1)
+                                journal.link(urlid, processed_url, depth + 1)
+                                url_write_data = {'URLID': urlid, 'depth': depth, 'url': processed_url}
+                                sink.write(item['ID'], url_write_data, 'url', linkruncnt)
+                                linkruncnt += 1
+                                ele_write_data = plan.link_data(uid, ele)
+                                sink.write(item['ID'],
+                                           ele_write_data,
+                                           'element', eleruncnt)
+                                eleruncnt += 1
+                    else:
+                        processed_url = raw_link.strip()
+                        if all_urls.add(processed_url):
+                            urlid += 1
+                            if data['scrapeSameDomain']:
+                                if get_domain(raw_link) == home_domain:
+                                    if debug:
+                                        logger.debug('Adding to queue: %s', (urlid, processed_url))
+                                    scheduler.push(urlid, processed_url, depth + 1)
+                                    journal.link(urlid, processed_url, depth + 1)
+                                    url_write_data = {'URLID': urlid, 'depth': depth, 'url': processed_url}
+                                    sink.write(item['ID'], url_write_data, 'url', linkruncnt)
+                                    linkruncnt += 1
+                                else:
+                                    journal.link(urlid, processed_url)
+                            else:
+                                if debug:
+                                    logger.debug('Adding to queue: %s', (urlid, processed_url))
+                                scheduler.push(urlid, processed_url, depth + 1)
+                                journal.link(urlid, processed_url, depth + 1)
+                                url_write_data = {'URLID': urlid, 'depth': depth, 'url': processed_url}
+                                sink.write(item['ID'], url_write_data, 'url', linkruncnt)
+                                linkruncnt += 1
+                            ele_write_data = plan.link_data(uid, ele)
+                            sink.write(item['ID'],
+                                       ele_write_data,
+                                       'element', eleruncnt)
+                            eleruncnt += 1
+            metrics.add('links', time.perf_counter() - start - (metrics.totals['write'] - written))
+            # Other elements. 'a' entries with targets are handled with the previous routine
+            for ele_write_data in element_data:
+                sink.write(item['ID'], ele_write_data, 'element', eleruncnt)
+                eleruncnt += 1
+            # The tree is full of reference cycles, break them so its memory is freed now instead of by the gc
+            soup.decompose()
+            soup = anchors = element_data = None
+        scheduler.done(uid)
+        pages += 1
+        if progress is not None:
+            with progress.get_lock():
+                progress.value += 1
 
-def update_status(filename, dat):
-    check_create_dir('status')
-    if depth is not None:
-        with open(path.join('status', filename), 'w') as f:
-            json.dump(dat, f)
+        # Checkpoint: output rows are flushed before the page is marked done in the journal.
+        # Sinks that write in large batches keep the journal records pending until their next flush
+        journal.done(uid, {'urlid': urlid, 'eleruncnt': eleruncnt, 'linkruncnt': linkruncnt},
+                     content if duplicate is None else None)
+        if sink.checkpoint():
+            start = time.perf_counter()
+            journal.commit()
+            metrics.add('status', time.perf_counter() - start)
+        metrics.page()
+    logger.info('All entries scraped')
+    scheduler.close()
+    if scheduler.spilled > 0:
+        logger.info('Frontier: {} urls spilled to disk'.format(scheduler.spilled))
+    sink.close(item['ID'])
+    journal.finish()
+    logger.info('Frontier: {0} unique urls, {1} duplicates skipped'.format(all_urls.added, all_urls.deduplicated))
+    if dedup is not None:
+        logger.info('Content: {0} exact and {1} near duplicates skipped'.format(
+            dedup.exact_duplicates - dedup_counts[0], dedup.near_duplicates - dedup_counts[1]))
+    logger.info('Total time taken for scrape: {} minute(s)'.format(((datetime.now() - start_time).seconds/60)))
+    return pages
 
 
-if __name__ == "__main__":
-    print('PageMiner')
-    # Init arguments
-    parser = argparse.ArgumentParser(description='Scrape test')
-    parser.add_argument('data', type=str)
-    args = parser.parse_args()
-    if '.json' in args.data:
-        with open(args.data, 'r') as f:
-            data = json.load(f)
-    else:
-        data = json.loads(args.data)
+# Input and resources of a worker process of the parallel runner
+worker_state = {}
 
-    # Init logging
+
+def init_logging(level='INFO'):
+    '''
+    Logs INFO and above to the console and level and above to a file in logs
+    :param level: Level of the log file, a name like 'debug' or a number. Debug messages are skipped without being
+    formatted when this is above DEBUG.
+    Messages logged for every page or link pass their arguments to the logger, so they are only formatted when kept
+    '''
+    if not isinstance(level, int):
+        name = str(level).upper()
+        level = logging.getLevelName(name)
+        if not isinstance(level, int):
+            raise Exception('Unknown logLevel: {}'.format(name))
     rootLogger = logging.getLogger()
-    rootLogger.setLevel(logging.DEBUG)
+    rootLogger.setLevel(min(level, logging.INFO))
     consoleHandler = logging.StreamHandler(stdout)
     consoleHandler.setFormatter(logging.Formatter('[%(name)s] - %(levelname)s - %(message)s'))
     check_create_dir('logs')
@@ -164,233 +433,100 @@ if __name__ == "__main__":
     fileHandler.setFormatter(logging.Formatter('%(asctime)s:-[%(name)s] - %(levelname)s - %(message)s'))
     consoleHandler.setLevel(logging.INFO)
     rootLogger.addHandler(consoleHandler)
-    fileHandler.setLevel(logging.DEBUG)
+    fileHandler.setLevel(level)
     rootLogger.addHandler(fileHandler)
 
-    # If some files already exist, find latest ID
-    working_urls = []
-    status = None
-    contscrape = False
-    contitem = False
-    cont_depth = None
-    cont_urls = None
-    cont_urlid = None
-    valid_ids = [ele['ID'] for ele in data['runURL']]
-    present_ids = []
-    try:
-        for filename in os.listdir('status'):
-            fileid = filename[int(filename.index('[') + 1): int(filename.index(']'))]
-            present_ids.append(fileid)
-        if len(present_ids) > 0:
-            latest_id = max(present_ids)
-            with open(path.join('status', 'status-[{}].json'.format(latest_id)), 'r') as f:
-                status = json.load(f)
-            if isinstance(status['urls'], list):
-                # General case: Last or not last depth but not last entry
-                rootLogger.info('Existing urls found, continuing scrape')
-                working_urls = data['runURL'][int(status['id']):]
-                cont_depth = status['depth']
-                cont_urls = status['urls']
-                cont_urlid = 1
-            else:
-                if status['urls'] == 'Full Complete':
-                    if latest_id == int(data['runURL'][-1]['ID']):
-                        # The entry with scraping completed is the last entry in the file
-                        rootLogger.info('All entries complete. Exiting')
-                        exit(0)
-                    else:
-                        # The entry with scraping completed is not the last entry in the file
-                        working_urls = data['runURL'][status['id'] + 1:]
-                        cont_depth = 0
-                        cont_urls = 'init'
-                        cont_urlid = 1
-                else:
-                    # Error case
-                    raise Exception('Invalid value for urls in status file')
-        else:
-            raise FileNotFoundError
-    except FileNotFoundError:
-        rootLogger.info('No existing files found. Starting from the beginning')
-        contscrape = False
-        working_urls = data['runURL']
 
-    for urlindex, item in enumerate(working_urls):
-        rootLogger.info('Item level Index: {0}, Id: {1}'.format(urlindex, item['ID']))
-        # Init variables
-        eleruncnt = 0
-        linkruncnt = 0
-        start_time = datetime.now()
-        priority_strings = data['pstrings'].split(',')
-        urlid = 1
-        urls = [(0, item['URL'])]
-        depth = 0
-        all_urls = []
-        home_domain = get_domain(item['URL'])
-        base_url = get_base_url(item['URL'])
-        if contscrape:
-            rootLogger.info('Contscrape triggered')
-            depth = cont_depth
-            if cont_urls == 'init':
-                urls = [(0, item['URL'])]
-            else:
-                urls = cont_urls
-            urlid = cont_urlid
-            contscrape = False
-        statusfile = 'status-[{}].json'.format(item['ID'])
-        statusdict = {'depth': depth, 'urls': None}
-        # Check for depth limit
-        while depth <= data['depth']:
-            rootLogger.info('Depth level depth: {0}, urls: {1}'.format(depth, urls))
-            new_urls = []
-            rootLogger.info('------------------------ Depth {} -------------------------'.format(depth))
+def init_worker(data, progress):
+    '''
+    Initializes a worker process of the parallel runner
+    :param data: The input json
+    :param progress: Shared counter of pages scraped across all processes
+    '''
+    if len(logging.getLogger().handlers) == 0:
+        # Worker was spawned instead of forked and did not inherit the log handlers
+        init_logging(data.get('logLevel', 'INFO'))
+    worker_state['data'] = data
+    worker_state['progress'] = progress
+    worker_state['resources'] = init_resources(data)
 
-            # Priority check: Find websites with specific keywords in them and push them to top of list
-            rootLogger.info('Starting priority check...')
-            for cnt, uele in enumerate(urls):
-                if any(pstr in uele[1].lower() for pstr in priority_strings):
-                    rootLogger.info('Priority link found: {}'.format(uele[1]))
-                    rootLogger.info('Moving to top')
-                    del urls[cnt]
-                    urls.insert(0, uele)
 
-            rootLogger.info('Starting scrape process')
-            for urlno, (uid, url) in enumerate(urls):
-                rootLogger.info('urls level urlno: {0}, ele: {1}'.format(urlno, (uid, url)))
-                rootLogger.info('Connecting to: {}'.format(url))
-                try:
-                    headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36'
-                                             ' (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36'}
-                    head_response = requests.head(url, headers=headers)
-                    if head_response.headers['content-type'].split(';')[0] != 'text/html':
-                        rootLogger.info(
-                            'Skipping due to invalid mime type: {}'.format(head_response.headers['content-type']))
-                        continue
-                    response = connect_with_timeout(url, headers)
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                except StopIteration:
-                    rootLogger.error('Connection timeout error. Omitting')
-                    ele_write_data = {'URLID': uid, 'url': url, 'depth': depth,
-                         'Connection error': 'The website was connected to but it took too long to retrieve data.'}
-                    update_csv(item['ID'], data['saveFileDir'], ele_write_data, 'element', eleruncnt)
-                    eleruncnt += 1
-                    continue
-                except Exception as exc:
-                    rootLogger.error('Connection error: {}  Omitting'.format(exc))
-                    ele_write_data = {'URLID': uid, 'url': url, 'depth': depth, 'Connection error': str(exc)}
-                    update_csv(item['ID'], data['saveFileDir'], ele_write_data, 'element', eleruncnt)
-                    eleruncnt += 1
-                    continue
-                # Link search routine
-                for ele in soup.find_all('a'):
-                    if data.get('limit', None) is not None and len(new_urls) == data['limit']:
-                        # 'limit' entry on the input json is used only for debug purposes.
-                        # This part is omitted when not included.
-                        break
-                    # Make sure element points to valid link
-                    if ele.get('href', None) is not None:
-                        try:
-                            raw_link = ele['href'].strip()
-                            if 'http' not in raw_link:
-                                if raw_link.startswith('/'):
-                                    processed_url = (base_url + raw_link[1:]).strip()
-                                    if processed_url not in all_urls:
-                                        urlid += 1
-                                        rootLogger.info('Adding to new_urls: {}'.format((urlid, processed_url)))
-                                        new_urls.append((urlid, processed_url))
-                                        all_urls.append(processed_url)
-                                        url_write_data = {'URLID': urlid, 'depth': depth, 'url': processed_url}
-                                        update_csv(item['ID'], data['saveFileDir'], url_write_data, 'url', linkruncnt)
-                                        linkruncnt += 1
-                                        # If 'a' is present in HTMLElementList, add its data onto element_data
-                                        ele_write_data = get_linkdata(uid, data['HTMLElementList'], ele)
-                                        update_csv(item['ID'], data['saveFileDir'], ele_write_data,
-                                                   'element', eleruncnt)
-                                        eleruncnt += 1
+def scrape_worker(item):
+    '''
+    Scrapes a runURL entry on a worker process
+    :param item: The runURL entry
+    :return: Tuple of (site ID, pages scraped, error message or None)
+    '''
+    logger = logging.getLogger(__name__ + '.scrape_worker')
+    try:
+        pages = scrape_site(item, worker_state['data'], worker_state['resources'], worker_state['progress'])
+        # Worker resources are never closed, so the metrics of the process are saved after every site
+        worker_state['resources']['metrics'].report()
+        return item['ID'], pages, None
+    except Exception as exc:
+        logger.exception('Entry {} failed'.format(item['ID']))
+        return item['ID'], 0, str(exc)
 
-                                else:
-                                    processed_url = (base_url + raw_link).strip()
-                                    if processed_url not in all_urls:
-                                        urlid += 1
-                                        rootLogger.info('Adding to new_urls: {}'.format((urlid, processed_url)))
-                                        new_urls.append((urlid, processed_url))
-                                        all_urls.append(processed_url)
-                                        url_write_data = {'URLID': urlid, 'depth': depth, 'url': processed_url}
-                                        update_csv(item['ID'], data['saveFileDir'], url_write_data, 'url', linkruncnt)
-                                        linkruncnt += 1
-                                        ele_write_data = get_linkdata(uid, data['HTMLElementList'], ele)
-                                        update_csv(item['ID'], data['saveFileDir'],
-                                                   ele_write_data,
-                                                   'element', eleruncnt)
-                                        eleruncnt += 1
-                            else:
-                                processed_url = raw_link.strip()
-                                if processed_url not in all_urls:
-                                    urlid += 1
-                                    all_urls.append(processed_url)
-                                    if data['scrapeSameDomain']:
-                                        if get_domain(raw_link) == home_domain:
-                                            rootLogger.info('Adding to new_urls: {}'.format((urlid, processed_url)))
-                                            new_urls.append((urlid, processed_url))
-                                            url_write_data = {'URLID': urlid, 'depth': depth, 'url': processed_url}
-                                            update_csv(item['ID'], data['saveFileDir'], url_write_data, 'url', linkruncnt)
-                                            linkruncnt += 1
-                                    else:
-                                        rootLogger.info('Adding to new_urls: {}'.format((urlid, processed_url)))
-                                        new_urls.append((urlid, processed_url))
-                                        url_write_data = {'URLID': urlid, 'depth': depth, 'url': processed_url}
-                                        update_csv(item['ID'], data['saveFileDir'], url_write_data, 'url', linkruncnt)
-                                        linkruncnt += 1
-                                    ele_write_data = get_linkdata(uid, data['HTMLElementList'], ele)
-                                    update_csv(item['ID'], data['saveFileDir'],
-                                               ele_write_data,
-                                               'element', eleruncnt)
-                                    eleruncnt += 1
-                        except StopIteration:
-                            rootLogger.error('Connection timeout error. Omitting')
-                            element_write_data = {'URLID': uid, 'url': url, 'depth': depth, 'Connection error':
-                                                  'The website was connected to but it took too long to retrieve data.'}
-                            update_csv(item['ID'], data['saveFileDir'], element_write_data, 'element', eleruncnt)
-                            eleruncnt += 1
-                            continue
-                # Find other elements
-                for i, element in enumerate(data['HTMLElementList']):
-                    # 'a' is omitted here since it is handled with the previous routine
-                    if 'a:' not in element:
-                        ele_write_data = get_elementdata(uid, i, element, soup)
-                        update_csv(item['ID'], data['saveFileDir'], ele_write_data, 'element', eleruncnt)
-                        eleruncnt += 1
 
-                # Update Status
-                statusdict['depth'] = depth
-                statusdict['id'] = item['ID']
-                statusdict['urls'] = list()
-                statusdict['contid'] = -1
-                rootLogger.info('Begin status save')
-                if depth == data['depth']:
-                    if urlno == (len(urls) - 1):
-                        # Last depth last entry
-                        rootLogger.info('All entries scraped')
-                        statusdict['urls'] = 'Full Complete'
-                    else:
-                        # Last depth but not last entry
-                        rootLogger.info('Current depth incomplete')
-                        statusdict['urls'].extend(urls[urlno + 1:])
+def run_parallel(data, processes, interval=30):
+    '''
+    Scrapes the runURL entries on a pool of worker processes. Entries are handed out one at a time from a shared
+    queue to whichever worker is idle, so a slow site only holds up its own worker.
+    Each site writes its own output and journal, so the result is the same as a sequential run.
+    If a worker process dies, e.g. killed for running out of memory, the pool can't be used anymore and the entries
+    that are not finished are marked failed. Running the script again resumes them from their journals
+    :param data: The input json
+    :param processes: Number of worker processes
+    :param interval: Seconds between progress reports
+    '''
+    logger = logging.getLogger(__name__ + '.run_parallel')
+    progress = multiprocessing.Value('i', 0)
+    total = len(data['runURL'])
+    done = 0
+    failed = 0
+    start_time = datetime.now()
+    logger.info('Parallel runner started with {0} processes for {1} entries'.format(processes, total))
+    with ProcessPoolExecutor(processes, initializer=init_worker, initargs=(data, progress)) as pool:
+        futures = {pool.submit(scrape_worker, item): item['ID'] for item in data['runURL']}
+        while len(futures) > 0:
+            finished, _ = wait(futures, timeout=interval, return_when=FIRST_COMPLETED)
+            for future in finished:
+                site_id = futures.pop(future)
+                done += 1
+                try:
+                    site_id, pages, error = future.result()
+                except BrokenProcessPool as exc:
+                    pages, error = 0, 'Worker process died: {}'.format(exc)
+                if error is not None:
+                    failed += 1
+                    logger.error('Entry {0} failed: {1}'.format(site_id, error))
                 else:
-                    if urlno == (len(urls) - 1):
-                        # Not last depth but last entry
-                        rootLogger.info('Current depth fully scraped')
-                        statusdict['urls'] = new_urls
-                        statusdict['contid'] = urlid + 1
-                        statusdict['depth'] += 1
-                    else:
-                        # Not last depth or last entry
-                        rootLogger.info('Current depth incomplete')
-                        statusdict['urls'].extend(urls[urlno + 1:])
-                rootLogger.info('Writing to status file')
-                update_status(statusfile, statusdict)
+                    logger.info('Entry {0} finished, {1} pages'.format(site_id, pages))
+            elapsed = (datetime.now() - start_time).total_seconds()
+            logger.info('Progress: {0}/{1} entries complete, {2} failed, {3} pages scraped, {4:.1f} pages/sec'.format(
+                done, total, failed, progress.value, progress.value / max(elapsed, 0.001)))
 
-            rootLogger.info('new_urls before transfer: {}'.format(new_urls))
-            urls = []
-            urls.extend(new_urls)
-            depth += 1
-        rootLogger.info('Total time taken for scrape: {} minute(s)'.format(((datetime.now() - start_time).seconds/60)))
\ No newline at end of file
+
+if __name__ == "__main__":
+    print('PageMiner')
+    # Init arguments
+    parser = argparse.ArgumentParser(description='Scrape test')
+    parser.add_argument('data', type=str)
+    args = parser.parse_args()
+    if '.json' in args.data:
+        with open(args.data, 'r') as f:
+            data = json.load(f)
+    else:
+        data = json.loads(args.data)
+
+    # Init logging
+    init_logging(data.get('logLevel', 'INFO'))
+
+    processes = int(data.get('processes', 1))
+    if processes > 1:
+        run_parallel(data, processes, float(data.get('progressInterval', 30)))
+    else:
+        resources = init_resources(data)
+        for item in data['runURL']:
+            scrape_site(item, data, resources)
+        close_resources(resources)
@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Status codes a server uses to ask us to slow down
+THROTTLE_CODES = (429, 503)
+
+
+def parse_retry_after(value):
+    '''
+    Parses a Retry-After header
+    :param value: Header value, either a number of seconds or an http date
+    :return: Number of seconds to wait or None if the header is missing or invalid
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class HostState:
+    '''
+    Token bucket, in-flight count and backoff of a single domain
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.inflight = 0
+        self.blocked_until = 0.0
+        self.throttles = 0
+
+
+class PolitenessScheduler:
+    '''
+    Limits the requests sent to each domain so that no single site is hammered while many sites are scraped at once.
+    Every domain has a token bucket of rate requests per second with room for burst requests, and at most
+    max_inflight requests open at a time. A 429 or 503 response blocks the domain for its Retry-After time, or an
+    exponential backoff if there is none, and halves the domain's rate. The rate recovers gradually with every
+    successful response.
+    Limits are per process, the parallel runner gives every worker process its own scheduler
+    '''
+
+    def __init__(self, key, rate=None, burst=1, max_inflight=None, backoff=1.0, max_backoff=300.0):
+        '''
+        :param key: Function mapping a url to the domain it is limited under
+        :param rate: Requests per second per domain, or None for no rate limit
+        :param burst: Number of requests a domain can send at once after being idle
+        :param max_inflight: Maximum number of open requests per domain, or None for no limit
+        :param backoff: Seconds a domain is blocked after its first throttled response without Retry-After
+        :param max_backoff: Maximum number of seconds a domain is blocked for
+        '''
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._hosts = {}
+        self._condition = threading.Condition()
+
+    def _host(self, domain):
+        host = self._hosts.get(domain, None)
+        if host is None:
+            host = HostState(self.rate, self.burst)
+            self._hosts[domain] = host
+        return host
+
+    def acquire(self, url):
+        '''
+        Blocks until a request to the domain of url is allowed
+        :param url: The url about to be requested
+        '''
+        domain = self.key(url)
+        with self._condition:
+            host = self._host(domain)
+            while True:
+                now = time.monotonic()
+                if host.rate is not None:
+                    host.tokens = min(float(self.burst), host.tokens + (now - host.updated) * host.rate)
+                host.updated = now
+                if now < host.blocked_until:
+                    self._condition.wait(host.blocked_until - now)
+                elif self.max_inflight is not None and host.inflight >= self.max_inflight:
+                    self._condition.wait()
+                elif host.rate is not None and host.tokens < 1:
+                    self._condition.wait((1 - host.tokens) / host.rate)
+                else:
+                    if host.rate is not None:
+                        host.tokens -= 1
+                    host.inflight += 1
+                    return
+
+    def observe(self, url, response):
+        '''
+        Adapts the domain's limits to the status of a response, as soon as its headers have arrived
+        :param url: The url that was requested
+        :param response: The response
+        :return: True if the response asked us to slow down
+        '''
+        logger = logging.getLogger(__name__ + '.observe')
+        domain = self.key(url)
+        with self._condition:
+            host = self._host(domain)
+            throttled = response.status_code in THROTTLE_CODES
+            if throttled:
+                host.throttles += 1
+                wait = parse_retry_after(response.headers.get('retry-after', None))
+                if wait is None:
+                    wait = self.backoff * 2 ** (host.throttles - 1)
+                wait = min(wait, self.max_backoff)
+                host.blocked_until = max(host.blocked_until, time.monotonic() + wait)
+                if host.rate is not None:
+                    host.rate = max(self.rate / 64, host.rate / 2)
+                logger.warning('Throttled by {0} ({1}), waiting {2:.1f}s'.format(domain, response.status_code, wait))
+            else:
+                host.throttles = 0
+                if host.rate is not None:
+                    host.rate = min(self.rate, host.rate + self.rate / 10)
+            self._condition.notify_all()
+            return throttled
+
+    def release(self, url):
+        '''
+        Frees the request slot taken by acquire. Should be called once the body has been read or the response closed,
+        so that max_inflight also bounds the downloads from a domain
+        :param url: The url that was requested
+        '''
+        domain = self.key(url)
+        with self._condition:
+            self._host(domain).inflight -= 1
+            self._condition.notify_all()
@@ -0,0 +1,323 @@
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import time
+from os import path
+
+
+def check_create_dir(dirname):
+    '''
+    Checks if directory exists and if it doesn't creates a new directory
+    :param dirname: Path to directory
+    '''
+    if not path.exists(dirname):
+        if '/' in dirname:
+            os.makedirs(dirname)
+        else:
+            os.mkdir(dirname)
+
+
+class RowSink:
+    '''
+    Base of the output sinks. Element and url rows of each site ID are buffered in memory until flush_rows rows are
+    pending or flush_seconds have passed since the last flush, and then written by the subclass.
+    checkpoint() should be called before writing a checkpoint, the journal may only be committed when it returns True
+    so that it never points past rows that are still in memory
+    '''
+
+    extension = None
+    # Flush from write() once flush_rows or flush_seconds is reached. Sinks that only flush from checkpoint() keep
+    # every file they write covered by the next journal commit
+    flush_on_write = True
+
+    def __init__(self, savedir, flush_rows=1000, flush_seconds=5.0, metrics=None):
+        '''
+        :param savedir: Directory to save the output files in
+        :param flush_rows: Number of buffered rows that triggers a flush
+        :param flush_seconds: Maximum number of seconds rows are kept in memory
+        :param metrics: Optional StageMetrics to add the write times to
+        '''
+        self.savedir = savedir
+        self.metrics = metrics
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self._buffers = {}
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def _filename(self, id, datatype):
+        if datatype == 'element':
+            return 'tempData-[{0}].{1}'.format(id, self.extension)
+        elif datatype == 'url':
+            return 'tempUrl-[{0}].{1}'.format(id, self.extension)
+        else:
+            raise Exception('Unknown type')
+
+    def _encode(self, rows, runcnt):
+        '''
+        :return: Buffered form of rows
+        '''
+        return rows
+
+    def _write(self, key, chunks):
+        '''
+        Writes the buffered chunks of a file
+        :param key: Tuple of (site ID, file name, datatype)
+        :param chunks: List of values returned by _encode
+        '''
+        raise NotImplementedError
+
+    def _close(self, key):
+        pass
+
+    def write(self, id, write_data, datatype, runcnt):
+        '''
+        Buffers rows for the output of id. Has the same semantics as the old per row update_csv
+        :param id: The site ID
+        :param write_data: Dictionary or list of dictionaries to write
+        :param datatype: 'element' for tempData or 'url' for tempUrl
+        :param runcnt: Number of previous writes of this datatype. The csv header is written when this is 0
+        '''
+        if not isinstance(write_data, list):
+            write_data = [write_data]
+        if len(write_data) == 0:
+            logging.getLogger(__name__ + '.write').debug('Nothing to write')
+            return
+        start = time.perf_counter()
+        key = (id, self._filename(id, datatype), datatype)
+        self._buffers.setdefault(key, []).append(self._encode(write_data, runcnt))
+        self._pending += len(write_data)
+        if self.metrics is not None:
+            self.metrics.add('write', time.perf_counter() - start)
+        if self.flush_on_write and self.due():
+            self.flush()
+
+    def due(self):
+        '''
+        :return: True once flush_rows rows are pending or flush_seconds have passed since the last flush
+        '''
+        return self._pending >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_seconds
+
+    def flush(self):
+        '''
+        Writes all buffered rows to their files
+        '''
+        start = time.perf_counter()
+        check_create_dir(self.savedir)
+        for key, chunks in self._buffers.items():
+            if len(chunks) == 0:
+                continue
+            self._write(key, chunks)
+            del chunks[:]
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        if self.metrics is not None:
+            self.metrics.add('write', time.perf_counter() - start)
+
+    def checkpoint(self):
+        '''
+        Makes the rows written so far durable
+        :return: True if no rows are left in memory and the journal can be committed
+        '''
+        self.flush()
+        return True
+
+    def close(self, id=None):
+        '''
+        Flushes buffered rows and closes the files of id, or of every site when id is None
+        :param id: The site ID
+        '''
+        self.flush()
+        for key in list(self._buffers.keys()):
+            if id is None or key[0] == id:
+                self._close(key)
+                self._buffers.pop(key)
+
+
+class CSVSink(RowSink):
+    '''
+    Writes element and url rows to the tempData/tempUrl csv files of each site ID.
+    Files are kept open and rows are formatted when they are written, so only text is buffered
+    '''
+
+    extension = 'csv'
+
+    def __init__(self, savedir, flush_rows=1000, flush_seconds=5.0, metrics=None):
+        super().__init__(savedir, flush_rows, flush_seconds, metrics)
+        self._files = {}
+
+    def _encode(self, rows, runcnt):
+        logger = logging.getLogger(__name__ + '.CSVSink')
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=list(rows[0].keys()) + ['error'], restval='n/a')
+        if runcnt == 0:
+            logger.debug('Writing header')
+            writer.writeheader()
+        for ele in rows:
+            if ele.get('target', None) is not None and '\n' in ele['target']:
+                ele['target'] = ele['target'].replace('\n', 'N%%L')
+            writer.writerow(ele)
+        return out.getvalue()
+
+    def _write(self, key, chunks):
+        writefile = self._files.get(key, None)
+        if writefile is None:
+            writefile = open(path.join(self.savedir, key[1]), 'a', newline='')
+            self._files[key] = writefile
+        writefile.write(''.join(chunks))
+        writefile.flush()
+
+    def _close(self, key):
+        writefile = self._files.pop(key, None)
+        if writefile is not None:
+            writefile.close()
+
+
+class JSONLinesSink(RowSink):
+    '''
+    Writes rows as one json object per line to tempData-[ID].jsonl(.gz/.zst). Newlines in the data are kept as is.
+    Every flush appends a complete gzip member or zstd frame, so the files can be read with the standard tools
+    and a crashed run leaves at most the last batch unreadable
+    '''
+
+    def __init__(self, savedir, compression='gzip', flush_rows=1000, flush_seconds=5.0, metrics=None):
+        '''
+        :param savedir: Directory to save the files in
+        :param compression: 'gzip', 'zstd' or None
+        :param flush_rows: Number of buffered rows that triggers a flush
+        :param flush_seconds: Maximum number of seconds rows are kept in memory
+        :param metrics: Optional StageMetrics to add the write times to
+        '''
+        super().__init__(savedir, flush_rows, flush_seconds, metrics)
+        if compression == 'gzip':
+            self.extension = 'jsonl.gz'
+            self._compress = lambda data: gzip.compress(data, compresslevel=6)
+        elif compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception('zstd compression needs the zstandard package installed')
+            self.extension = 'jsonl.zst'
+            self._compress = zstandard.ZstdCompressor(level=3).compress
+        elif compression is None:
+            self.extension = 'jsonl'
+            self._compress = None
+        else:
+            raise Exception('Unknown compression: {}'.format(compression))
+
+    def _encode(self, rows, runcnt):
+        return ''.join(json.dumps(row, ensure_ascii=False, default=str) + '\n' for row in rows)
+
+    def _write(self, key, chunks):
+        data = ''.join(chunks).encode('utf-8')
+        if self._compress is not None:
+            data = self._compress(data)
+        with open(path.join(self.savedir, key[1]), 'ab') as writefile:
+            writefile.write(data)
+
+
+class ParquetSink(RowSink):
+    '''
+    Writes rows to Parquet files with a fixed schema per datatype, the element name column dictionary encoded.
+    A Parquet file is only readable once it is closed, so every flush writes a new part file
+    tempData-[ID]-NNNNN.parquet in row groups of row_group_rows. Parts should be large, so they are only written by
+    checkpoint(), between pages, once flush_rows rows are pending or flush_seconds have passed, and the journal is
+    committed right after every part
+    '''
+
+    extension = 'parquet'
+    flush_on_write = False
+
+    def __init__(self, savedir, compression='zstd', flush_rows=100000, flush_seconds=300.0, row_group_rows=100000,
+                 metrics=None):
+        '''
+        :param savedir: Directory to save the files in
+        :param compression: Parquet column compression, e.g. 'zstd', 'snappy', 'gzip' or None
+        :param flush_rows: Number of buffered rows that triggers writing a part file
+        :param flush_seconds: Maximum number of seconds rows are kept in memory
+        :param row_group_rows: Maximum number of rows per row group
+        :param metrics: Optional StageMetrics to add the write times to
+        '''
+        super().__init__(savedir, flush_rows, flush_seconds, metrics)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception('Parquet output needs the pyarrow package installed')
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.compression = compression or 'none'
+        self.row_group_rows = row_group_rows
+        self._schemas = {
+            'element': pyarrow.schema([('URLID', pyarrow.int64()), ('DataID', pyarrow.int64()),
+                                       ('element', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+                                       ('target', pyarrow.string()), ('url', pyarrow.string()),
+                                       ('depth', pyarrow.int64()), ('Connection error', pyarrow.string()),
+                                       ('duplicate', pyarrow.string()), ('duplicateOf', pyarrow.int64()),
+                                       ('duplicateSite', pyarrow.string())]),
+            'url': pyarrow.schema([('URLID', pyarrow.int64()), ('depth', pyarrow.int64()),
+                                   ('url', pyarrow.string())])
+        }
+        # Next part number of each file
+        self._parts = {}
+
+    def _next_part(self, key):
+        basename = key[1][:-len('.parquet')]
+        part = self._parts.get(key, None)
+        if part is None:
+            # Continue the numbering of a resumed scrape
+            prefix = basename + '-'
+            existing = [int(name[len(prefix):-len('.parquet')]) for name in os.listdir(self.savedir)
+                        if name.startswith(prefix) and name.endswith('.parquet')]
+            part = max(existing) + 1 if len(existing) > 0 else 0
+        self._parts[key] = part + 1
+        return path.join(self.savedir, '{0}-{1:05d}.parquet'.format(basename, part))
+
+    def _write(self, key, chunks):
+        schema = self._schemas[key[2]]
+        columns = {name: [] for name in schema.names}
+        for rows in chunks:
+            for row in rows:
+                for name, values in columns.items():
+                    value = row.get(name, None)
+                    if value is not None and not isinstance(value, (str, int)):
+                        value = str(value)
+                    values.append(value)
+        table = self._pa.Table.from_pydict(columns, schema=schema)
+        filename = self._next_part(key)
+        self._pq.write_table(table, filename + '.tmp', row_group_size=self.row_group_rows,
+                             compression=self.compression)
+        os.replace(filename + '.tmp', filename)
+
+    def checkpoint(self):
+        if self._pending == 0 or self.due():
+            self.flush()
+            return True
+        return False
+
+
+def make_sink(output_format, savedir, compression=None, flush_rows=None, flush_seconds=None, metrics=None):
+    '''
+    Creates the sink for an output format
+    :param output_format: 'csv', 'jsonl' or 'parquet'
+    :param savedir: Directory to save the output files in
+    :param compression: Compression of the jsonl and parquet formats. Defaults to gzip for jsonl and zstd for parquet
+    :param flush_rows: Number of buffered rows that triggers a flush, or None for the format's default
+    :param flush_seconds: Maximum number of seconds rows are kept in memory, or None for the format's default
+    :param metrics: Optional StageMetrics to add the write times to
+    :return: The sink
+    '''
+    if output_format == 'csv':
+        return CSVSink(savedir, int(flush_rows or 1000), float(flush_seconds or 5), metrics)
+    elif output_format == 'jsonl':
+        compression = compression or 'gzip'
+        return JSONLinesSink(savedir, None if compression == 'none' else compression, int(flush_rows or 1000),
+                             float(flush_seconds or 5), metrics)
+    elif output_format == 'parquet':
+        return ParquetSink(savedir, compression or 'zstd', int(flush_rows or 100000), float(flush_seconds or 300),
+                           metrics=metrics)
+    else:
+        raise Exception('Unknown output format: {}'.format(output_format))